@@ -0,0 +1,231 @@
+"""
+Benchmarks of overlapy's matchers and of Overlapy.run() on synthetic data.
+
+A synthetic pretraining dataset (Zipfian token frequencies, log-normal example
+lengths) and a synthetic testset are generated, and some testset ngrams are planted
+in a fraction of the examples. For each engine, the benchmark measures the build
+time of the matcher, its throughput (examples and tokens per second) in a single
+process and the throughput of Overlapy.run() for each number of workers, along with
+peak memory (RSS). The matcher benchmark also runs on the Aho-Corasick matcher of
+stringology, which overlapy used before its own, as a throughput baseline. Each measurement runs in a fresh process, which generates the
+data, so that peak memory (data included) is not carried over from the previous
+measurements. Results are written as JSON lines, one per measurement, so that they
+can be tracked across versions:
+
+    python benchmarks/benchmark_overlapy.py --examples 20000 --workers 1 2 4 -o results.jsonl
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+from multiprocessing import cpu_count
+from os.path import abspath, dirname
+
+from stringology.ac import AhoCorasick
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import overlapy  # noqa: E402
+from overlapy import (  # noqa: E402
+    ENGINES,
+    Overlapy,
+    OverlapyTestSet,
+    OverlapyVocabulary,
+)
+
+
+class BaselineMatcher:
+    """
+    The matcher interface over stringology's AhoCorasick.
+    """
+
+    def __init__(self, ngrams):
+        self.ac = AhoCorasick(ngrams)
+
+    def __call__(self, examples):
+        matches = collections.defaultdict(list)
+        for i, example in enumerate(examples):
+            for ngram, _ in self.ac(example):
+                matches[ngram].append(i)
+        return matches
+
+
+BASELINE = "stringology"
+
+
+def zipf_sampler(rng, vocabulary_size, exponent=1.1):
+    weights = [1 / (rank**exponent) for rank in range(1, vocabulary_size + 1)]
+    tokens = [f"w{rank}" for rank in range(vocabulary_size)]
+
+    def sample(k):
+        return rng.choices(tokens, weights=weights, k=k)
+
+    return sample
+
+
+def synthetic_data(args):
+    rng = random.Random(args.seed)
+    sample = zipf_sampler(rng, args.vocabulary_size)
+    examples = [
+        sample(max(1, int(rng.lognormvariate(args.length_mu, args.length_sigma))))
+        for _ in range(args.testset_examples)
+    ]
+    testset = OverlapyTestSet(
+        "synthetic", min_n=args.n, max_n=args.n, percentile=0, examples=examples
+    )
+    dataset = [
+        sample(max(1, int(rng.lognormvariate(args.length_mu, args.length_sigma))))
+        for _ in range(args.examples)
+    ]
+    ngrams = [ngram for ngram in testset.ngrams()]
+    for example in rng.sample(dataset, int(args.contamination * len(dataset))):
+        position = rng.randrange(len(example) + 1)
+        example[position:position] = rng.choice(ngrams)
+    return testset, dataset
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+def _measure(connection, benchmark, args):
+    connection.send(benchmark(*args))
+
+
+def measure(benchmark, *args):
+    """
+    Runs benchmark(*args) in a fresh (spawned, not forked) process and returns its
+    result, so that the peak memory it reports is its own: ru_maxrss only ever
+    grows within a process, and so does RUSAGE_CHILDREN over its children.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure, args=(sender, benchmark, args))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"{benchmark.__name__} failed") from None
+    finally:
+        process.join()
+
+
+def benchmark_matcher(engine, args):
+    testset, dataset = synthetic_data(args)
+    batch_size = args.batch_size
+    matcher_class = BaselineMatcher if engine == BASELINE else ENGINES[engine]
+    ngrams = set(map(tuple, testset.ngrams()))
+    examples = dataset
+    if getattr(matcher_class, "requires_vocabulary", False):
+        vocabulary = OverlapyVocabulary.from_testsets([testset])
+        ngrams = {tuple(vocabulary.encode(ngram)) for ngram in ngrams}
+        examples = [vocabulary.encode(example) for example in dataset]
+
+    start = time.perf_counter()
+    matcher = matcher_class(ngrams)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_matches = 0
+    for i in range(0, len(examples), batch_size):
+        for occurrences in matcher(examples[i : i + batch_size]).values():
+            n_matches += len(occurrences)
+    elapsed = time.perf_counter() - start
+    return {
+        "tokens": sum(map(len, examples)),
+        "build_time": build_time,
+        "scan_time": elapsed,
+        "examples_per_second": len(examples) / elapsed,
+        "tokens_per_second": sum(map(len, examples)) / elapsed,
+        "matches": n_matches,
+        "peak_rss": peak_rss(),
+    }
+
+
+def benchmark_run(engine, n_workers, args):
+    testset, dataset = synthetic_data(args)
+    start = time.perf_counter()
+    runner = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=n_workers,
+        chunk_size=args.chunk_size,
+        engine=engine,
+        batch_size=args.batch_size,
+        results="counts",
+    )
+    matches = runner.run()
+    elapsed = time.perf_counter() - start
+    return {
+        "tokens": sum(map(len, dataset)),
+        "time": elapsed,
+        "examples_per_second": len(dataset) / elapsed,
+        "tokens_per_second": sum(map(len, dataset)) / elapsed,
+        "matches": sum(matches.values()),
+        "peak_rss": peak_rss(),
+        "peak_rss_workers": peak_rss(resource.RUSAGE_CHILDREN),
+        "utilization": [stats["utilization"] for stats in runner.worker_stats.values()],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--examples", type=int, default=5000)
+    parser.add_argument("--testset-examples", type=int, default=1000)
+    parser.add_argument("--n", type=int, default=13, help="ngram size")
+    parser.add_argument("--vocabulary-size", type=int, default=50000)
+    parser.add_argument("--length-mu", type=float, default=5.5)
+    parser.add_argument("--length-sigma", type=float, default=1.0)
+    parser.add_argument("--contamination", type=float, default=0.01)
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES))
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, cpu_count()])
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=overlapy.MATCH_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="JSON lines file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    engines = [e for e in args.engines if e != "numpy" or overlapy.np is not None]
+    workers = sorted({w for w in args.workers if w <= cpu_count()})
+    common = {
+        "version": overlapy.__version__,
+        "python": platform.python_version(),
+        "cpu_count": cpu_count(),
+        "parameters": vars(args),
+    }
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        result = measure(benchmark_matcher, BASELINE, args)
+        record = dict(common, benchmark="matcher", engine=BASELINE, **result)
+        print(json.dumps(record), file=output, flush=True)
+        for engine in engines:
+            result = measure(benchmark_matcher, engine, args)
+            record = dict(common, benchmark="matcher", engine=engine, **result)
+            print(json.dumps(record), file=output, flush=True)
+            for n_workers in workers:
+                result = measure(benchmark_run, engine, n_workers, args)
+                record = dict(
+                    common,
+                    benchmark="run",
+                    engine=engine,
+                    n_workers=n_workers,
+                    **result,
+                )
+                print(json.dumps(record), file=output, flush=True)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
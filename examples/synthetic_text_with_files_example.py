@@ -1,6 +1,6 @@
 from os.path import join
 
-from overlapy import OverlapyTestSet, Overlapy
+from overlapy import Overlapy, OverlapyPrefetchReader, OverlapyTestSet
 
 # This example uses the same pretraining dataset and testset
 # as synthetic_text_example.py, but stored in files for demonstration purposes
@@ -57,3 +57,13 @@ matches = overlapy.run()
 #    #3 matches on T V Z E
 # As we had noted above
 print(f"Matches: {list(testset.get_matches(matches))}")
+
+# Alternatively, the files can be read concurrently, ahead of the workers, by an
+# OverlapyPrefetchReader, so that the workers do not wait on I/O.
+# It is streamed to the workers, so the matches are the same.
+reader = OverlapyPrefetchReader(
+    [join("files", f"pretraining_dataset.{idx}.txt") for idx in range(5)],
+    decode=lambda data: tokenizer(data.decode().rstrip()),
+)
+matches = Overlapy(testsets=[testset], dataset=reader, n_workers=2).run()
+print(f"Matches (prefetched): {list(testset.get_matches(matches))}")
@@ -0,0 +1,58 @@
+import random
+import string
+import time
+
+from overlapy import OverlapyTokenizer
+
+# This example compares the throughput of the tokenizer shipped with overlapy with
+# the nltk based tokenizer used in the HuggingFace examples. Both implement the
+# tokenization of https://arxiv.org/abs/2005.14165 (alphanumeric, whitespace-delimited,
+# lowercased tokens), with slight differences: see OverlapyTokenizer.
+
+try:
+    import nltk
+
+    nltk.download("punkt", quiet=True)
+
+    def nltk_tokenizer(s):
+        return [word.lower() for word in nltk.word_tokenize(s) if word.isalnum()]
+
+except ImportError:
+    nltk_tokenizer = None
+
+
+def synthetic_texts(n_texts, seed=0):
+    # Web-like texts: words of random length, with some punctuation and capitals.
+    rng = random.Random(seed)
+    words = [
+        "".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(1, 10)))
+        for _ in range(5000)
+    ]
+    punctuation = [" ", " ", " ", " ", ", ", ". ", "! ", "\n"]
+    return [
+        "".join(
+            rng.choice(words) + rng.choice(punctuation)
+            for _ in range(int(rng.lognormvariate(5, 1)))
+        )
+        for _ in range(n_texts)
+    ]
+
+
+def benchmark(name, tokenizer, texts):
+    size = sum(map(len, texts)) / 1e6
+    start = time.perf_counter()
+    n_tokens = sum(len(tokenizer(text)) for text in texts)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name}: {size / elapsed:.2f} MB/s, {n_tokens / elapsed:,.0f} tokens/s "
+        f"({n_tokens:,} tokens in {elapsed:.2f}s)"
+    )
+
+
+texts = synthetic_texts(2000)
+print(f"{len(texts)} texts, {sum(map(len, texts)) / 1e6:.1f} MB")
+benchmark("overlapy", OverlapyTokenizer(), texts)
+if nltk_tokenizer is not None:
+    benchmark("nltk", nltk_tokenizer, texts)
+else:
+    print("nltk is not installed: skipping its benchmark")
@@ -1,11 +1,56 @@
+import argparse
+import asyncio
+import bisect
 import collections
-from itertools import chain
-from multiprocessing import Pool, cpu_count
+import csv
+import functools
+import gc
+import glob
+import gzip
+import hashlib
+import heapq
+import importlib
+import io
+import json
+import math
+import mmap
+import os
+import pickle
+import queue
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, groupby, islice, repeat
+from multiprocessing import AuthenticationError, Lock, Pool, Process, cpu_count
+from multiprocessing.connection import Client, Listener
+from multiprocessing.sharedctypes import RawArray, RawValue
 from typing import Iterable
 
 from stringology.ac import AhoCorasick
 from stringology.ngrams import all_ngrams
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 try:
     from tqdm.auto import tqdm
 
@@ -32,6 +77,34 @@ __version__ = "0.0.1"
 __author__ = "Ruben Branco, Luís Gomes"
 __copyright__ = "copyright © 2021, Ruben Branco, Luís Gomes, all rights reserved"
 
+# Number of examples per work unit when streaming a dataset (see Overlapy).
+STREAMING_CHUNK_SIZE = 1000
+
+# Number of examples per work unit of checkpointed runs, when chunk_size is not set.
+CHECKPOINT_CHUNK_SIZE = 10000
+
+# Number of examples handed to the matcher at once by each worker (see Overlapy).
+MATCH_BATCH_SIZE = 256
+
+# Number of token positions whose suffixes are sorted in memory at once, and number
+# of tokens compared at once between suffixes (see OverlapySuffixArray).
+SUFFIX_ARRAY_SHARD_SIZE = 1 << 22
+SUFFIX_KEY_DEPTH = 16
+
+# Number of suffixes compared at once, over all shards, when merging the sorted shards
+# of a suffix array with numpy (see OverlapySuffixArray).
+SUFFIX_MERGE_BLOCK_SIZE = 1 << 20
+
+# Number of documents sent at once by the threads reading shards (see OverlapyShardReader).
+READER_BATCH_SIZE = 1024
+
+# Number of shingles whose MinHash values are computed at once (see OverlapyMinHash).
+MINHASH_CHUNK_SIZE = 1 << 14
+
+# Ngram fingerprints are polynomial hashes of token ids, modulo 2**64.
+FINGERPRINT_BASE = 0x100000001B3
+FINGERPRINT_MASK = (1 << 64) - 1
+
 
 class OverlapyTestSet:
     def __init__(self, name, min_n=8, max_n=13, percentile=5, examples=None):
@@ -43,9 +116,21 @@ class OverlapyTestSet:
         self.max_n = max_n
         self.percentile = percentile
         self.examples = examples or []
+        self._ngram_index = None
+        # bumped on every change of the examples through the testset
+        self._version = 0
 
     def add_example(self, example):
         self.examples.append(example)
+        self._version += 1
+
+    def reset(self):
+        """
+        Drops the state derived from the examples (see ngram_index()). Call it after
+        editing the examples in place, which the testset cannot detect.
+        """
+        self._ngram_index = None
+        self._version += 1
 
     @staticmethod
     def get_percentile(values, percentile):
@@ -73,6 +158,25 @@ class OverlapyTestSet:
         for example in self.examples:
             yield from all_ngrams(example, minn=n, maxn=n)
 
+    def ngram_index(self):
+        """
+        Returns a dictionary mapping each ngram (as a tuple) to its occurrences
+        in the testset, as a list of (example id, position).
+
+        The index is built on first use and rebuilt when N changes or examples are
+        added. In-place edits of the examples are not detected: call reset() after
+        them.
+        """
+        key = self.compute_n(), self._version
+        if self._ngram_index is None or self._ngram_index[0] != key:
+            n = self.compute_n()
+            index = collections.defaultdict(list)
+            for i, example in enumerate(self.examples):
+                for position, ngram in enumerate(all_ngrams(example, minn=n, maxn=n)):
+                    index[tuple(ngram)].append((i, position))
+            self._ngram_index = key, index
+        return self._ngram_index[1]
+
     def __len__(self):
         return len(self.examples)
 
@@ -89,84 +193,3519 @@ class OverlapyTestSet:
 
         The structure of the output is the following:
         Example ID, Ngram, Match position within example sequence.
+
+        Ngrams of size N are looked up in the ngram index (see ngram_index()), and so
+        are longer ngrams (e.g. from other testsets), by their first N tokens, the
+        rest being compared with the example. So the cost is proportional to the
+        number of matches: the examples are only scanned for shorter ngrams, if
+        there are any.
+        """
+        index = self.ngram_index()
+        n = self.compute_n()
+        found = []
+        shorter = []
+        for ngram in matches.keys():
+            if len(ngram) < n:
+                shorter.append(ngram)
+                continue
+            key = tuple(ngram)
+            for i, position in index.get(key[:n], ()):
+                if len(ngram) == n or (
+                    tuple(self.examples[i][position : position + len(ngram)]) == key
+                ):
+                    found.append((i, ngram, position))
+        if shorter:
+            ac = AhoCorasick(shorter)
+            for i, example in enumerate(self.examples):
+                found.extend((i, ngram, position) for ngram, position in ac(example))
+
+        # Same order as scanning each example: by end of the match, longest first.
+        found.sort(key=lambda m: (m[0], m[2] + len(m[1]), -len(m[1])))
+        yield from found
+
+    def report(self, matches, top_k=5):
+        """
+        Given a dictionary of matches (see Overlapy.run()), returns the contamination
+        report of the testset, as columns with one row per example:
+            * "example": the index of the example.
+            * "ngrams": its number of ngrams of size N (see compute_n()).
+            * "matched": how many of them matched.
+            * "overlap": the fraction of them that matched.
+            * "documents": the number of distinct dataset documents matching any of
+              them, unless the matches are counts.
+            * "top_ngrams": its top_k matched ngrams that occur most in the dataset.
+        Only matched ngrams of size N are considered. Columns are numpy arrays, when
+        numpy is available, computed with array operations over the matches.
+        """
+        n = self.compute_n()
+        index = self.ngram_index()
+        # The index is keyed by tuples, matches by the ngrams as matched (e.g. str).
+        matched = []
+        values = []
+        for key, value in matches.items():
+            ngram = tuple(key)
+            if len(ngram) == n and ngram in index:
+                matched.append(ngram)
+                values.append(value)
+        with_documents = all(not isinstance(value, int) for value in values)
+        frequencies = [
+            value if isinstance(value, int) else len(value) for value in values
+        ]
+        lengths = [len(example) for example in self.examples]
+        if np is None:
+            return self._report(matched, values, frequencies, lengths, top_k)
+
+        n_examples = len(self.examples)
+        # occurrences of the matched ngrams in the testset, as (example, ngram) rows
+        occurrences = [index[ngram] for ngram in matched]
+        occurrence_ngram = np.repeat(
+            np.arange(len(matched)), [len(occurrence) for occurrence in occurrences]
+        )
+        occurrence_example = np.fromiter(
+            (i for occurrence in occurrences for i, _ in occurrence),
+            dtype=np.int64,
+            count=len(occurrence_ngram),
+        )
+        n_ngrams = np.maximum(np.array(lengths, dtype=np.int64) - n + 1, 0)
+        n_matched = np.bincount(occurrence_example, minlength=n_examples)
+        report = {
+            "example": np.arange(n_examples),
+            "ngrams": n_ngrams,
+            "matched": n_matched,
+            "overlap": np.divide(
+                n_matched,
+                n_ngrams,
+                out=np.zeros(n_examples),
+                where=n_ngrams > 0,
+            ),
+        }
+
+        pairs = np.unique(occurrence_example * len(matched) + occurrence_ngram)
+        pair_example = pairs // max(len(matched), 1)
+        pair_ngram = pairs % max(len(matched), 1)
+        if with_documents:
+            counts = np.array(frequencies, dtype=np.int64)
+            documents = np.concatenate(
+                [np.asarray(value, dtype=np.int64) for value in values]
+                or [np.zeros(0, dtype=np.int64)]
+            )
+            # the documents of each (example, ngram) pair, gathered from the
+            # concatenated documents of the ngrams
+            pair_counts = counts[pair_ngram]
+            starts = (np.cumsum(counts) - counts)[pair_ngram]
+            gather = np.repeat(
+                starts - (np.cumsum(pair_counts) - pair_counts), pair_counts
+            )
+            gather += np.arange(len(gather))
+            keys = np.unique(
+                np.repeat(pair_example, pair_counts) * (documents.max(initial=0) + 1)
+                + documents[gather]
+            )
+            report["documents"] = np.bincount(
+                keys // (documents.max(initial=0) + 1), minlength=n_examples
+            )
+
+        # pairs sorted by example, then by decreasing frequency of the ngram
+        frequency = np.array(frequencies, dtype=np.int64)[pair_ngram]
+        order = np.lexsort((-frequency, pair_example))
+        pair_example, pair_ngram = pair_example[order], pair_ngram[order]
+        firsts = np.searchsorted(pair_example, pair_example)
+        top = np.flatnonzero(np.arange(len(pair_example)) - firsts < top_k)
+        top_ngrams = [[] for _ in range(n_examples)]
+        for i, j in zip(pair_example[top].tolist(), pair_ngram[top].tolist()):
+            top_ngrams[i].append(matched[j])
+        report["top_ngrams"] = top_ngrams
+        return report
+
+    def _report(self, matched, values, frequencies, lengths, top_k):
+        """
+        report() without numpy.
+        """
+        n = self.compute_n()
+        index = self.ngram_index()
+        n_matched = [0] * len(self.examples)
+        documents = [set() for _ in self.examples]
+        ngrams = [set() for _ in self.examples]
+        for j, (ngram, value) in enumerate(zip(matched, values)):
+            for i, _ in index[ngram]:
+                n_matched[i] += 1
+                ngrams[i].add(j)
+                if not isinstance(value, int):
+                    documents[i].update(value)
+        n_ngrams = [max(length - n + 1, 0) for length in lengths]
+        report = {
+            "example": list(range(len(self.examples))),
+            "ngrams": n_ngrams,
+            "matched": n_matched,
+            "overlap": [m / t if t else 0.0 for m, t in zip(n_matched, n_ngrams)],
+        }
+        if all(not isinstance(value, int) for value in values):
+            report["documents"] = list(map(len, documents))
+        report["top_ngrams"] = [
+            [matched[j] for j in sorted(js, key=lambda j: (-frequencies[j], j))[:top_k]]
+            for js in ngrams
+        ]
+        return report
+
+    def export_report(self, matches, path, format="csv", top_k=5, max_overlap=0.0):
+        """
+        Writes the contamination report of the testset (see report()) to the
+        directory path, as {name}.report.csv or, with format="parquet" (which
+        requires pyarrow), {name}.report.parquet. The examples whose overlap is at
+        most max_overlap (by default, those without any match) are written to
+        {name}.clean.jsonl and the others to {name}.dirty.jsonl, as
+        {"example": index, "tokens": [...]} records. Returns the report.
+        """
+        assert format in ("csv", "parquet")
+        report = self.report(matches, top_k=top_k)
+        os.makedirs(path, exist_ok=True)
+        columns = {
+            key: column.tolist() if hasattr(column, "tolist") else list(column)
+            for key, column in report.items()
+        }
+        columns["top_ngrams"] = [
+            [" ".join(map(str, ngram)) for ngram in ngrams]
+            for ngrams in report["top_ngrams"]
+        ]
+        base = os.path.join(path, self.name)
+        if format == "parquet":
+            if pyarrow is None:
+                raise ImportError("Exporting to parquet requires pyarrow")
+            pyarrow.parquet.write_table(
+                pyarrow.table(columns), base + ".report.parquet"
+            )
+        else:
+            with open(base + ".report.csv", "w", newline="") as fw:
+                writer = csv.writer(fw)
+                writer.writerow(columns)
+                for row in zip(*columns.values()):
+                    writer.writerow(
+                        json.dumps(x) if isinstance(x, list) else x for x in row
+                    )
+        with open(base + ".clean.jsonl", "w") as clean, open(
+            base + ".dirty.jsonl", "w"
+        ) as dirty:
+            for i, overlap in enumerate(columns["overlap"]):
+                record = {"example": i, "tokens": list(self.examples[i])}
+                fw = clean if overlap <= max_overlap else dirty
+                fw.write(json.dumps(record) + "\n")
+        return report
+
+
+class OverlapyVocabulary:
+    """
+    Maps tokens to integer ids, so that ngrams and examples can be matched as compact
+    integer sequences rather than sequences of strings.
+
+    The vocabulary holds the testset tokens only: every other token is encoded as
+    UNKNOWN, which no ngram contains, so it interrupts any match in progress.
+    """
+
+    UNKNOWN = 0
+
+    def __init__(self, tokens=()):
+        self.tokens = [None]
+        self.ids = {}
+        for token in tokens:
+            self.add(token)
+
+    @classmethod
+    def from_testsets(cls, testsets):
+        return cls(
+            token for testset in testsets for example in testset for token in example
+        )
+
+    def add(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tokens):
         """
-        ac = AhoCorasick(matches.keys())
+        Encodes a sequence of tokens as an array("I") of ids.
+        """
+        return array("I", map(self.ids.get, tokens, repeat(OverlapyVocabulary.UNKNOWN)))
+
+    def decode(self, ids):
+        """
+        Decodes a sequence of ids into a tuple of tokens.
+        """
+        return tuple(self.tokens[i] for i in ids)
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class OverlapyTokenizer:
+    """
+    Reference tokenizer of the methodology of Brown, Tom B., et al. (see compute_n()):
+    alphanumeric, whitespace-delimited, lowercased tokens.
+
+    Tokens are the maximal runs of alphanumeric characters of the lowercased text; any
+    other character delimits them. Unlike filtering nltk.word_tokenize() with
+    str.isalnum() (as in the examples), punctuation within words splits them instead
+    of dropping them ("e-mail" gives "e" and "mail").
+
+    ASCII texts go through bytes.translate() and a single split, non-ASCII texts
+    through a compiled regular expression: in both cases there is no Python-level
+    loop over characters or tokens.
+    """
 
-        for i, example in enumerate(self.examples):
-            for ngram, position in ac(example):
-                yield i, ngram, position
+    PATTERN = re.compile(r"[^\W_]+")
+    ASCII_TABLE = bytes(
+        ord(chr(c).lower()) if chr(c).isalnum() else ord(" ") for c in range(128)
+    ) + bytes(128)
+
+    def __call__(self, text):
+        if text.isascii():
+            return (
+                text.encode().translate(OverlapyTokenizer.ASCII_TABLE).decode().split()
+            )
+        return OverlapyTokenizer.PATTERN.findall(text.lower())
+
+    def batch(self, texts):
+        return list(map(self, texts))
+
+    def encode(self, text, vocabulary):
+        """
+        Tokenizes a text directly into an array of token ids of the vocabulary.
+        """
+        return vocabulary.encode(self(text))
 
 
 class OverlapyNgramMatcher:
+    """
+    Aho-Corasick matcher over a set of ngrams.
+
+    The automaton is stored as flat arrays rather than as a graph of node objects:
+    the edges of each state are a slice of the labels/targets arrays, sorted by label
+    (offsets[state]:offsets[state + 1]), next to the failure link, output link and
+    depth of every state. Scanning only reads these buffers, so that forked workers
+    keep sharing their pages instead of copying them on reference count updates, and
+    they can be saved in an OverlapyIndex and memory-mapped back.
+
+    Bisecting the edges of the states visited most (the root and the states with
+    at least DENSE_DEGREE edges, listed in the dense array) would dominate the scan,
+    so their edges are also kept in dictionaries keyed by symbol, built in each
+    process from the arrays; they are a small fraction of the automaton. States with
+    a single edge compare it directly.
+
+    Ngrams of non-negative integers (token ids) are used as labels directly, other
+    symbols are numbered through an alphabet dictionary.
+    """
+
+    DENSE_DEGREE = 8
+
+    def __init__(self, ngrams: set):
+        ngrams = [tuple(ngram) for ngram in ngrams]
+        symbols = set(chain.from_iterable(ngrams))
+        if all(type(symbol) is int and 0 <= symbol <= 0xFFFFFFFF for symbol in symbols):
+            self.alphabet = None
+        else:
+            self.alphabet = {symbol: i for i, symbol in enumerate(symbols)}
+            ngrams = [tuple(map(self.alphabet.__getitem__, n)) for n in ngrams]
+
+        # Builds the automaton with goto dictionaries first, then flattens it.
+        trie, is_pattern, depth = [{}], [False], [0]
+        for pattern in ngrams:
+            state = 0
+            for k, label in enumerate(pattern, start=1):
+                next_state = trie[state].get(label)
+                if next_state is None:
+                    next_state = len(trie)
+                    trie[state][label] = next_state
+                    trie.append({})
+                    is_pattern.append(False)
+                    depth.append(k)
+                state = next_state
+            is_pattern[state] = True
+
+        # fail[state] is the longest proper suffix of state that is also a state,
+        # output[state] is the longest such suffix (state included) which is a pattern.
+        # The root (state 0) is never a pattern, so 0 doubles as "no output".
+        fail = [0] * len(trie)
+        output = [0] * len(trie)
+        to_visit = [0]
+        for state in to_visit:
+            for label, child in trie[state].items():
+                to_visit.append(child)
+                if state:
+                    link = fail[state]
+                    while link and label not in trie[link]:
+                        link = fail[link]
+                    fail[child] = trie[link].get(label, 0)
+                output[child] = child if is_pattern[child] else output[fail[child]]
+
+        self.offsets = array("I", [0])
+        self.labels = array("I")
+        self.targets = array("I")
+        self.dense = array("I")
+        for state, edges in enumerate(trie):
+            for label in sorted(edges):
+                self.labels.append(label)
+                self.targets.append(edges[label])
+            self.offsets.append(len(self.labels))
+            if not state or len(edges) >= self.DENSE_DEGREE:
+                self.dense.append(state)
+        self.fail = array("I", fail)
+        self.output = array("I", output)
+        self.depth = array("I", depth)
+        self.is_pattern = array("B", is_pattern)
+        self._build_edges()
+
+    def _build_edges(self):
+        offsets, labels, targets = self.offsets, self.labels, self.targets
+        symbols = None if self.alphabet is None else list(self.alphabet)
+        self.edges = {}
+        for state in self.dense:
+            lo, hi = offsets[state], offsets[state + 1]
+            keys = (
+                labels[lo:hi]
+                if symbols is None
+                else map(symbols.__getitem__, labels[lo:hi])
+            )
+            self.edges[state] = dict(zip(keys, targets[lo:hi]))
+
+    def __getstate__(self):
+        # The edge dictionaries are built again from the arrays.
+        state = self.__dict__.copy()
+        del state["edges"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_edges()
+
+    @classmethod
+    def from_tables(cls, tables, alphabet=None):
+        """
+        Builds a matcher over the arrays of tables() (e.g. memory-mapped from an
+        OverlapyIndex), without copying them, except for the pattern flags, which
+        discard() updates.
+        """
+        matcher = cls.__new__(cls)
+        for name, values in tables.items():
+            setattr(matcher, name, values)
+        matcher.is_pattern = array("B", matcher.is_pattern)
+        matcher.alphabet = alphabet
+        matcher._build_edges()
+        return matcher
+
+    def tables(self):
+        return {
+            name: getattr(self, name)
+            for name in (
+                "offsets",
+                "labels",
+                "targets",
+                "dense",
+                "fail",
+                "output",
+                "depth",
+                "is_pattern",
+            )
+        }
+
+    def scan(self, example):
+        """
+        Yields (ngram, position) for every occurrence of an ngram in the example.
+        """
+        offsets, labels, targets, fail, output, depth, is_pattern, alphabet = (
+            self.offsets,
+            self.labels,
+            self.targets,
+            self.fail,
+            self.output,
+            self.depth,
+            self.is_pattern,
+            self.alphabet,
+        )
+        root = self.edges[0]
+        dense_edges = self.edges.get
+        # Matches are slices of the example, as tuples unless it is a str or tuple.
+        as_ngram = None if isinstance(example, (str, tuple)) else tuple
+        bisect_left = bisect.bisect_left
+        # Symbols out of the alphabet get a label no edge has.
+        missing = None if alphabet is None else len(alphabet)
+        state = 0
+        for position, symbol in enumerate(example, start=1):
+            while state:
+                edges = dense_edges(state)
+                if edges is not None:
+                    if symbol in edges:
+                        state = edges[symbol]
+                        break
+                else:
+                    label = symbol if missing is None else alphabet.get(symbol, missing)
+                    lo = offsets[state]
+                    hi = offsets[state + 1]
+                    if hi - lo == 1:
+                        if labels[lo] == label:
+                            state = targets[lo]
+                            break
+                    else:
+                        i = bisect_left(labels, label, lo, hi)
+                        if i < hi and labels[i] == label:
+                            state = targets[i]
+                            break
+                state = fail[state]
+            else:
+                state = root.get(symbol, 0)
+                if not state:
+                    continue
+            match = output[state]
+            while match:
+                # Discarded ngrams stay on the output chains, but are skipped.
+                if is_pattern[match]:
+                    start = position - depth[match]
+                    ngram = example[start:position]
+                    yield ngram if as_ngram is None else as_ngram(ngram), start
+                match = output[fail[match]]
+
+    def __call__(self, examples):
+        matches = collections.defaultdict(list)
+        for i, example in enumerate(examples):
+            for ngram, _ in self.scan(example):
+                matches[ngram].append(i)
+        return matches
+
+    def _find(self, ngram):
+        """
+        Returns the state of an ngram, or 0 if it is not in the automaton.
+        """
+        state = 0
+        for symbol in ngram:
+            label = symbol if self.alphabet is None else self.alphabet.get(symbol)
+            if label is None:
+                return 0
+            hi = self.offsets[state + 1]
+            i = bisect.bisect_left(self.labels, label, self.offsets[state], hi)
+            if i == hi or self.labels[i] != label:
+                return 0
+            state = self.targets[i]
+        return state
+
+    def discard(self, ngrams):
+        """
+        Stops matching the given ngrams. Their states are kept, but no longer output.
+        Only their pattern flags change, so the cost depends on the ngrams discarded,
+        not on the size of the automaton.
+        """
+        for ngram in ngrams:
+            state = self._find(ngram)
+            if state:
+                self.is_pattern[state] = 0
+
+
+def fingerprint(ids):
+    """
+    Computes the fingerprint of a sequence of token ids.
+    """
+    h = 0
+    for token_id in ids:
+        h = (h * FINGERPRINT_BASE + token_id) & FINGERPRINT_MASK
+    return h
+
+
+def rolling_fingerprints(example, n):
+    """
+    Yields (start, fingerprint) for every window of n token ids of the example.
+    """
+    leading = pow(FINGERPRINT_BASE, n - 1, FINGERPRINT_MASK + 1)
+    h = 0
+    for position, token_id in enumerate(example):
+        if position >= n:
+            h -= example[position - n] * leading
+        h = (h * FINGERPRINT_BASE + token_id) & FINGERPRINT_MASK
+        if position >= n - 1:
+            yield position - n + 1, h
+
+
+def _concatenate(examples):
+    """
+    Concatenates examples of token ids into a single uint64 array, returned together
+    with the index of the example each token comes from.
+    """
+    lengths = np.fromiter(map(len, examples), dtype=np.int64, count=len(examples))
+    if not lengths.sum():
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    tokens = np.concatenate(
+        [np.asarray(example, dtype=np.uint64) for example in examples]
+    )
+    return tokens, np.repeat(np.arange(len(examples)), lengths)
+
+
+def _window_fingerprints(tokens, example_of, n):
+    """
+    Computes the fingerprints of the windows of n tokens of concatenated examples
+    (see _concatenate), along with a mask of the windows lying within one example.
+    """
+    n_windows = max(len(tokens) - n + 1, 0)
+    hashes = np.zeros(n_windows, dtype=np.uint64)
+    for j in range(n):
+        hashes = hashes * np.uint64(FINGERPRINT_BASE) + tokens[j : j + n_windows]
+    return hashes, example_of[:n_windows] == example_of[n - 1 :]
+
+
+class OverlapyHashMatcher:
+    """
+    Matcher over a set of ngrams of token ids (see OverlapyVocabulary), based on a
+    rolling hash.
+
+    For each ngram size, a window of that many tokens is slid over the example while
+    its fingerprint is updated in constant time, and looked up in a table of the
+    ngram fingerprints. Hits are confirmed by comparing the tokens, so hash collisions
+    cannot produce false matches. It is a lighter alternative to the Aho-Corasick
+    automaton when there are only a few ngram sizes (one per testset).
+    """
+
+    requires_vocabulary = True
+
     def __init__(self, ngrams: set):
-        self.ac = AhoCorasick(ngrams)
+        # tables[n] maps fingerprints to ngrams of size n; fingerprints shared by
+        # several ngrams map to a list of them instead.
+        self.tables = {}
+        for ngram in ngrams:
+            ngram = tuple(ngram)
+            table = self.tables.setdefault(len(ngram), {})
+            h = fingerprint(ngram)
+            other = table.get(h)
+            if other is None:
+                table[h] = ngram
+            elif isinstance(other, list):
+                other.append(ngram)
+            elif other != ngram:
+                table[h] = [other, ngram]
+        # Factor of the token leaving the window: FINGERPRINT_BASE ** (n - 1)
+        self.leading = {
+            n: pow(FINGERPRINT_BASE, n - 1, FINGERPRINT_MASK + 1) for n in self.tables
+        }
+
+    def scan(self, example):
+        """
+        Yields (ngram, position) for every occurrence of an ngram in the example.
+        """
+        for n, table in self.tables.items():
+            leading = self.leading[n]
+            h = 0
+            for position, token_id in enumerate(example):
+                if position >= n:
+                    h -= example[position - n] * leading
+                h = (h * FINGERPRINT_BASE + token_id) & FINGERPRINT_MASK
+                candidate = table.get(h)
+                if candidate is not None and position >= n - 1:
+                    start = position - n + 1
+                    window = tuple(example[start : position + 1])
+                    if isinstance(candidate, list):
+                        if window in candidate:
+                            yield window, start
+                    elif candidate == window:
+                        yield candidate, start
 
     def __call__(self, examples):
         matches = collections.defaultdict(list)
         for i, example in enumerate(examples):
-            for ngram, _ in self.ac(example):
+            for ngram, _ in self.scan(example):
                 matches[ngram].append(i)
         return matches
 
+    def discard(self, ngrams):
+        """
+        Stops matching the given ngrams.
+        """
+        for ngram in ngrams:
+            ngram = tuple(ngram)
+            table = self.tables.get(len(ngram))
+            if table is None:
+                continue
+            h = fingerprint(ngram)
+            other = table.get(h)
+            if other == ngram:
+                del table[h]
+            elif isinstance(other, list) and ngram in other:
+                other.remove(ngram)
+                if len(other) == 1:
+                    table[h] = other[0]
+        for n in [n for n, table in self.tables.items() if not table]:
+            del self.tables[n]
+            del self.leading[n]
+
+
+class OverlapyNumpyMatcher:
+    """
+    Batch matcher over a set of ngrams of token ids (see OverlapyVocabulary), using NumPy.
+
+    A batch of examples is concatenated into a single array. For each ngram size, the
+    fingerprints (see fingerprint()) of all the windows of the batch are computed with
+    vectorized operations and searched in the sorted fingerprints of the ngrams.
+    Windows spanning two examples are discarded and hits are confirmed by comparing
+    the tokens, so there are no false matches. Only the matches are handled in Python.
+    """
+
+    requires_vocabulary = True
+
+    def __init__(self, ngrams: set):
+        if np is None:
+            raise ImportError("OverlapyNumpyMatcher requires numpy")
+        by_size = collections.defaultdict(list)
+        for ngram in ngrams:
+            by_size[len(ngram)].append(tuple(ngram))
+        # tables[n] holds the sorted fingerprints of the ngrams of size n and the ngrams
+        # themselves (one per row, in the same order).
+        self.tables = {}
+        for n, group in by_size.items():
+            rows = np.array(group, dtype=np.uint64).reshape(len(group), n)
+            hashes = np.zeros(len(group), dtype=np.uint64)
+            for j in range(n):
+                hashes = hashes * np.uint64(FINGERPRINT_BASE) + rows[:, j]
+            order = np.argsort(hashes, kind="stable")
+            self.tables[n] = (hashes[order], rows[order])
+
+    @classmethod
+    def from_tables(cls, tables):
+        """
+        Creates a matcher from prebuilt tables, mapping each ngram size n to the sorted
+        fingerprints of the ngrams and the ngrams themselves, one per row, as arrays
+        (see OverlapyIndex.matcher()).
+        """
+        if np is None:
+            raise ImportError("OverlapyNumpyMatcher requires numpy")
+        matcher = cls.__new__(cls)
+        matcher.tables = tables
+        return matcher
+
+    def __call__(self, examples):
+        matches = collections.defaultdict(list)
+        tokens, example_of = _concatenate(examples)
+
+        for n, (hashes, rows) in self.tables.items():
+            window_hashes, within = _window_fingerprints(tokens, example_of, n)
+            if not len(window_hashes):
+                continue
+            found = np.minimum(np.searchsorted(hashes, window_hashes), len(hashes) - 1)
+            hits = np.flatnonzero((hashes[found] == window_hashes) & within)
+            if not len(hits):
+                continue
+            windows = tokens[hits[:, None] + np.arange(n)]
+            for start, window, row in zip(hits, windows, found[hits]):
+                # Fingerprints shared by several ngrams are consecutive in the table.
+                while not np.array_equal(rows[row], window):
+                    row += 1
+                    if row == len(hashes) or hashes[row] != hashes[row - 1]:
+                        break
+                else:
+                    matches[tuple(window.tolist())].append(int(example_of[start]))
+        return matches
+
+    def discard(self, ngrams):
+        """
+        Stops matching the given ngrams.
+        """
+        by_size = collections.defaultdict(set)
+        for ngram in ngrams:
+            by_size[len(ngram)].add(tuple(ngram))
+        for n, group in by_size.items():
+            if n not in self.tables:
+                continue
+            hashes, rows = self.tables[n]
+            group_hashes = np.array(list(map(fingerprint, group)), dtype=np.uint64)
+            keep = np.ones(len(hashes), dtype=bool)
+            for row in np.flatnonzero(np.isin(hashes, group_hashes)):
+                keep[row] = tuple(rows[row].tolist()) not in group
+            if keep.all():
+                continue
+            if keep.any():
+                self.tables[n] = (hashes[keep], rows[keep])
+            else:
+                del self.tables[n]
+
+
+class OverlapyBloomFilter:
+    """
+    Bloom filter over the fingerprints (see fingerprint()) of a set of ngrams of token ids.
+
+    It is used as a prefilter in front of the matcher: an example none of whose windows
+    is in the filter cannot contain any of the ngrams, and is discarded without being
+    matched. A fraction fp_rate of the windows not in the set pass the filter anyway;
+    the matcher then rejects them.
+    """
+
+    def __init__(self, ngrams: set, fp_rate=0.01):
+        assert 0 < fp_rate < 1
+        start = time.perf_counter()
+        ngrams = set(map(tuple, ngrams))
+        self.sizes = sorted({len(ngram) for ngram in ngrams})
+        self.n_bits = max(
+            math.ceil(-len(ngrams) * math.log(fp_rate) / math.log(2) ** 2), 8
+        )
+        self.n_hashes = max(round(self.n_bits / max(len(ngrams), 1) * math.log(2)), 1)
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        for ngram in ngrams:
+            self.add(fingerprint(ngram))
+        self.build_time = time.perf_counter() - start
+
+    @staticmethod
+    def _mix(h):
+        # splitmix64 finalizer: spreads the fingerprint over all 64 bits
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & FINGERPRINT_MASK
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & FINGERPRINT_MASK
+        return h ^ (h >> 31)
+
+    def _bit_positions(self, h):
+        h = OverlapyBloomFilter._mix(h)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, h):
+        for bit in self._bit_positions(h):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, h):
+        return all(
+            self.bits[bit >> 3] & (1 << (bit & 7)) for bit in self._bit_positions(h)
+        )
+
+    def __len__(self):
+        """
+        Size of the filter, in bytes.
+        """
+        return len(self.bits)
+
+    def may_match(self, example):
+        """
+        Whether the example (a sequence of token ids) has any window in the filter.
+        """
+        return any(
+            h in self for n in self.sizes for _, h in rolling_fingerprints(example, n)
+        )
+
+    def candidates(self, examples):
+        """
+        Returns the indexes of the examples that may contain an ngram.
+        """
+        if np is None:
+            return [i for i, example in enumerate(examples) if self.may_match(example)]
+        tokens, example_of = _concatenate(examples)
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        candidate = np.zeros(len(examples), dtype=bool)
+        for n in self.sizes:
+            hashes, within = _window_fingerprints(tokens, example_of, n)
+            h = hashes[within]
+            h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            h = h ^ (h >> np.uint64(31))
+            h1, h2 = h & np.uint64(0xFFFFFFFF), (h >> np.uint64(32)) | np.uint64(1)
+            present = np.ones(len(h), dtype=bool)
+            for i in range(self.n_hashes):
+                bit = (h1 + np.uint64(i) * h2) % np.uint64(self.n_bits)
+                present &= (
+                    bits[bit >> np.uint64(3)] >> (bit & np.uint64(7)).astype(np.uint8)
+                ) & 1 == 1
+            candidate[example_of[: len(within)][within][present]] = True
+        return np.flatnonzero(candidate).tolist()
+
+
+class OverlapyIndex:
+    """
+    Index of the ngrams of a list of testsets, which can be saved to a file and loaded
+    back by memory-mapping it, so that it does not have to be recomputed on every run.
+
+    It holds the vocabulary of the testsets, their ngrams encoded as token ids and
+    grouped by size, the fingerprints of the ngrams (sorted, ready for matching) and
+    the provenance of each ngram: (testset, example, position) for each occurrence.
+    The tables of the Aho-Corasick automaton over the ngrams are stored as well (see
+    OverlapyNgramMatcher), so that loading the default matcher costs no rebuild.
+    A hash of the testsets' content is stored along, to detect stale indexes.
+
+    The file starts with a JSON header, followed by the raw arrays, which are exposed
+    as memoryviews over the mapped file (no copy). Tokens must be JSON serializable.
+    """
+
+    MAGIC = b"OVERLAPY"
+    VERSION = 2
+
+    def __init__(self, header, arrays, buffer=None):
+        self.header = header
+        self.arrays = arrays
+        self.buffer = buffer
+        self.vocabulary = OverlapyVocabulary(header["vocabulary"])
+        self.content_hash = header["content_hash"]
+        self.sizes = header["sizes"]
+        # Ngram ids are assigned consecutively, size after size.
+        self.first_ids = {}
+        n_ngrams = 0
+        for n in self.sizes:
+            self.first_ids[n] = n_ngrams
+            n_ngrams += len(self.arrays[f"hashes_{n}"])
+        self.n_ngrams = n_ngrams
+
+    @staticmethod
+    def testsets_hash(testsets):
+        h = hashlib.sha256()
+        for testset in testsets:
+            content = [testset.name, testset.compute_n(), [list(e) for e in testset]]
+            h.update(json.dumps(content, default=repr).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def build(cls, testsets):
+        vocabulary = OverlapyVocabulary.from_testsets(testsets)
+        occurrences = collections.defaultdict(list)
+        for t, testset in enumerate(testsets):
+            n = testset.compute_n()
+            for e, example in enumerate(testset):
+                ids = vocabulary.encode(example)
+                for position in range(len(ids) - n + 1):
+                    occurrences[tuple(ids[position : position + n])].append(
+                        (t, e, position)
+                    )
+
+        by_size = collections.defaultdict(list)
+        for ngram in occurrences:
+            by_size[len(ngram)].append((fingerprint(ngram), ngram))
+        arrays = {"provenance_offsets": array("Q", [0]), "provenance": array("I")}
+        for n in sorted(by_size):
+            group = sorted(by_size[n])
+            arrays[f"hashes_{n}"] = array("Q", (h for h, _ in group))
+            arrays[f"ngrams_{n}"] = array("I", chain.from_iterable(g for _, g in group))
+            for _, ngram in group:
+                arrays["provenance"].extend(chain.from_iterable(occurrences[ngram]))
+                arrays["provenance_offsets"].append(len(arrays["provenance"]) // 3)
+
+        header = {
+            "version": cls.VERSION,
+            "byteorder": sys.byteorder,
+            "content_hash": cls.testsets_hash(testsets),
+            "testsets": [
+                {
+                    "name": testset.name,
+                    "n": testset.compute_n(),
+                    "examples": len(testset),
+                }
+                for testset in testsets
+            ],
+            "sizes": sorted(by_size),
+            "vocabulary": vocabulary.tokens[1:],
+        }
+        index = cls(header, arrays)
+        for name, values in OverlapyNgramMatcher(index.ngrams()).tables().items():
+            arrays[f"ac_{name}"] = values
+        return index
+
+    def save(self, path):
+        header = dict(self.header, arrays={})
+        offset = 0
+        for name, values in self.arrays.items():
+            typecode = (
+                values.format if isinstance(values, memoryview) else values.typecode
+            )
+            header["arrays"][name] = [typecode, offset, len(values)]
+            offset += _align(len(values) * values.itemsize)
+        header = json.dumps(header).encode()
+        with open(path, "wb") as fw:
+            fw.write(OverlapyIndex.MAGIC)
+            fw.write(len(header).to_bytes(8, "little"))
+            fw.write(header)
+            fw.write(bytes(_align(fw.tell()) - fw.tell()))
+            for values in self.arrays.values():
+                data = memoryview(values).cast("B")
+                fw.write(data)
+                fw.write(bytes(_align(len(data)) - len(data)))
+
+    @classmethod
+    def load(cls, path, testsets=None):
+        """
+        Loads an index by memory-mapping it. When testsets are given, raises
+        ValueError if the index was not built from them.
+        """
+        with open(path, "rb") as fr:
+            buffer = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[: len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError(f"{path} is not an overlapy index")
+        header_start = len(cls.MAGIC) + 8
+        header_size = int.from_bytes(buffer[len(cls.MAGIC) : header_start], "little")
+        header = json.loads(buffer[header_start : header_start + header_size])
+        if header["version"] != cls.VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} is an incompatible overlapy index")
+        data = memoryview(buffer)[_align(header_start + header_size) :]
+        arrays = {}
+        for name, (typecode, offset, length) in header.pop("arrays").items():
+            size = array(typecode).itemsize
+            arrays[name] = data[offset : offset + length * size].cast(typecode)
+        index = cls(header, arrays, buffer)
+        if testsets is not None and index.is_stale(testsets):
+            raise ValueError(f"{path} is stale: the testsets have changed")
+        return index
+
+    def is_stale(self, testsets):
+        return self.content_hash != OverlapyIndex.testsets_hash(testsets)
+
+    def ngrams(self):
+        """
+        Yields every ngram, as a tuple of token ids, in order of ngram id.
+        """
+        for n in self.sizes:
+            rows = self.arrays[f"ngrams_{n}"]
+            for i in range(0, len(rows), n):
+                yield tuple(rows[i : i + n])
+
+    def find(self, ngram):
+        """
+        Returns the id of an ngram (a sequence of token ids), or None if it is not indexed.
+        """
+        n = len(ngram)
+        if n not in self.first_ids:
+            return None
+        hashes, rows = self.arrays[f"hashes_{n}"], self.arrays[f"ngrams_{n}"]
+        ngram = tuple(ngram)
+        h = fingerprint(ngram)
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            if tuple(rows[i * n : (i + 1) * n]) == ngram:
+                return self.first_ids[n] + i
+            i += 1
+        return None
+
+    def provenance(self, ngram):
+        """
+        Returns the occurrences of an ngram (a sequence of tokens) in the testsets,
+        as a list of (testset name, example id, position).
+        """
+        i = self.find(self.vocabulary.encode(ngram))
+        if i is None:
+            return []
+        offsets, provenance = (
+            self.arrays["provenance_offsets"],
+            self.arrays["provenance"],
+        )
+        names = [testset["name"] for testset in self.header["testsets"]]
+        occurrences = provenance[3 * offsets[i] : 3 * offsets[i + 1]]
+        return [
+            (names[occurrences[j]], occurrences[j + 1], occurrences[j + 2])
+            for j in range(0, len(occurrences), 3)
+        ]
+
+    def matcher(self, engine="aho-corasick"):
+        """
+        Builds the matcher of the given engine (see ENGINES) over the indexed ngrams.
+        The "aho-corasick" and "numpy" engines use the index's arrays directly.
+        """
+        if engine == "aho-corasick":
+            return OverlapyNgramMatcher.from_tables(
+                {
+                    name[len("ac_") :]: values
+                    for name, values in self.arrays.items()
+                    if name.startswith("ac_")
+                }
+            )
+        if engine == "numpy":
+            return OverlapyNumpyMatcher.from_tables(
+                {
+                    n: (
+                        np.frombuffer(self.arrays[f"hashes_{n}"], dtype=np.uint64),
+                        np.frombuffer(
+                            self.arrays[f"ngrams_{n}"], dtype=np.uint32
+                        ).reshape(-1, n),
+                    )
+                    for n in self.sizes
+                }
+            )
+        return ENGINES[engine](self.ngrams())
+
+
+def _align(offset, alignment=8):
+    return -(-offset // alignment) * alignment
+
 
 class Overlapy:
     def __init__(
-        self, testsets: list, dataset: Iterable, n_workers=cpu_count()
+        self,
+        testsets: list,
+        dataset: Iterable,
+        n_workers=cpu_count(),
+        chunk_size=None,
+        streaming=None,
+        results="occurrences",
+        vocabulary=None,
+        engine="aho-corasick",
+        batch_size=MATCH_BATCH_SIZE,
+        prefilter=None,
+        index=None,
+        metrics=None,
+        metrics_interval=10.0,
+        progress=True,
+        stop_after=None,
+        dedup_cache=None,
     ):
+        """
+        chunk_size selects the scheduling of the dataset over the workers. When None,
+        each worker gets one contiguous slice of the dataset. Otherwise, the dataset is
+        split into batches of chunk_size examples, which are handed out to whichever
+        worker is idle, so that skewed example lengths do not leave workers waiting.
+
+        streaming selects how examples are read from the dataset. Random access datasets
+        (with __len__ and __getitem__) are read by the workers themselves. Any other
+        iterable (e.g. a generator over files) is streamed: the examples are pulled from
+        it in batches of chunk_size (STREAMING_CHUNK_SIZE by default) and sent to the
+        workers, with a bounded number of batches in flight, so memory stays constant.
+        Matches then refer to the offset of the example within the stream.
+        When None, streaming is used for datasets that do not support random access.
+
+        results selects what run() records for each matched ngram:
+            * "occurrences": a list with the dataset index of every occurrence (the default).
+            * "documents": a sorted array("I") of the distinct dataset indexes it occurs in.
+            * "counts": the number of occurrences.
+        The compact forms keep boilerplate ngrams, which can occur millions of times,
+        from blowing up the memory of the workers and of the parent.
+
+        vocabulary, when True, encodes the testset ngrams and the dataset examples as
+        integer ids of an OverlapyVocabulary built from the testsets, which shrinks the
+        matcher and speeds up matching. The returned ngrams are decoded back to tokens.
+        When None, it is used if the engine requires it.
+
+        engine selects the matcher (see ENGINES):
+            * "aho-corasick": OverlapyNgramMatcher (the default).
+            * "rolling-hash": OverlapyHashMatcher, which requires the vocabulary.
+            * "numpy": OverlapyNumpyMatcher, which requires the vocabulary and numpy.
+
+        batch_size is the number of examples each worker hands to the matcher at once.
+
+        prefilter, when set to a false positive rate, puts an OverlapyBloomFilter over the
+        testset ngrams in front of the matcher, so that examples which cannot contain any
+        ngram are discarded cheaply. It requires the vocabulary. After the run,
+        prefilter_stats holds the filter's build time, size and rejection rate.
+
+        index, an OverlapyIndex, provides the testset ngrams and vocabulary instead of
+        computing them from the testsets, which are then only used to check that the
+        index is not stale (ValueError). The vocabulary is always used with an index.
+
+        The dataset may be an OverlapyTokenizedCorpus, whose examples are already token
+        ids: they are translated to the ids of the vocabulary (always used then) with a
+        lookup table, instead of being tokenized and encoded again.
+
+        metrics, a callable or a writable file, receives metrics of the run every
+        metrics_interval seconds and once more when it ends: the examples, tokens and
+        matches processed so far (the workers publish them batch after batch, through
+        shared counters) and their throughput, the timings of each phase
+        (ngram extraction, matcher build, scan and merge), the depth of the task queue
+        and the throughput of each worker. A callable is called with each record
+        (a dict), a file gets it as a line of JSON. The last record is kept in
+        last_metrics. progress=False turns off the progress bars, e.g. in batch jobs.
+
+        stop_after turns the run into a query of which testset examples are
+        contaminated, where not every occurrence matters: an ngram stops being
+        tracked once it has been seen stop_after times, which makes the examples it
+        occurs in contaminated, and so does every ngram which only occurs in
+        contaminated examples. The workers share this state and remove such ngrams
+        from their matchers as the run progresses. The matches are truncated
+        accordingly, and after the run, contaminated maps the name of each testset
+        to the sorted indexes of its contaminated examples. A resumed run counts the
+        matches of the finished work units first, which requires "occurrences" or
+        "counts" results.
+
+        dedup_cache, when set to a number of entries, puts a cache of the matches of
+        examples by content hash in front of the matcher, so that exact duplicates
+        (mirrors, boilerplate pages, reposts) are matched only once: a duplicate gets
+        the cached matches, attributed to its own index. The hashes of the examples
+        without matches are shared by all workers, in a table of dedup_cache entries;
+        each worker keeps the matches of up to dedup_cache other examples, evicting
+        the least recently used. After the run, dedup_stats holds the hit rate.
+        """
         assert n_workers <= cpu_count()
+        assert chunk_size is None or chunk_size >= 1
+        assert results in RESULTS
+        assert batch_size >= 1
+        assert engine in ENGINES
+        assert stop_after is None or (stop_after >= 1 and testsets)
+        assert dedup_cache is None or dedup_cache >= 1
+        requires_vocabulary = getattr(ENGINES[engine], "requires_vocabulary", False)
+        requires_vocabulary = requires_vocabulary or prefilter is not None
+        requires_vocabulary = requires_vocabulary or index is not None
+        requires_vocabulary = requires_vocabulary or isinstance(
+            dataset, OverlapyTokenizedCorpus
+        )
+        if vocabulary is None:
+            vocabulary = requires_vocabulary
+        assert vocabulary or not requires_vocabulary
+        if index is not None and testsets and index.is_stale(testsets):
+            raise ValueError("The index is stale: the testsets have changed")
+        if streaming is None:
+            streaming = not (
+                hasattr(dataset, "__len__") and hasattr(dataset, "__getitem__")
+            )
+        if streaming and chunk_size is None:
+            chunk_size = STREAMING_CHUNK_SIZE
         self.dataset = dataset
         self.testsets = testsets
-        self.testset_ngrams = set(
-            map(tuple, chain(*[list(testset.ngrams()) for testset in testsets]))
-        )
+        self.index = index
+        self.testset_ngrams = None
+        start = time.perf_counter()
+        if index is None:
+            self.testset_ngrams = set(
+                map(tuple, chain(*[list(testset.ngrams()) for testset in testsets]))
+            )
+        self.phase_times = {"ngrams": time.perf_counter() - start}
         self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.streaming = streaming
+        self.results = results
+        self.vocabulary = None
+        if index is not None:
+            self.vocabulary = index.vocabulary
+        elif vocabulary:
+            self.vocabulary = OverlapyVocabulary.from_testsets(testsets)
+        self.engine = engine
+        self.batch_size = batch_size
+        self.prefilter = prefilter
+        self.metrics = metrics
+        self.metrics_interval = metrics_interval
+        self.progress = progress
+        self.stop_after = stop_after
+        self.contaminated = {}
+        self.dedup_cache = dedup_cache
+        self.dedup_stats = {}
+        self.worker_stats = {}
+        self.prefilter_stats = {}
+        self.last_metrics = None
 
-    def _calculate_chunk_matches(self, args):
+    def _tasks(self, chunk_size):
+        """
+        Work units handed to the pool: (dataset indexes, progress bar position, examples).
+        Examples are only shipped with the task when streaming; otherwise the workers
+        read them from the dataset by index.
         """
-        Calculates matches between the testset ngrams and a chunk of the given dataset.
+        if self.streaming:
+            return self._streaming_tasks(chunk_size)
+        idxs = range(len(self.dataset))
+        if chunk_size is None:
+            return [
+                (chunk, n_worker, None)
+                for n_worker, chunk in enumerate(list_split(idxs, self.n_workers))
+            ]
+        return [
+            (idxs[i : i + chunk_size], None, None)
+            for i in range(0, len(idxs), chunk_size)
+        ]
 
-        This function is executed by each worker from a pool of workers (processes).
+    def _streaming_tasks(self, chunk_size):
+        iterator = iter(self.dataset)
+        start = 0
+        while True:
+            examples = list(islice(iterator, chunk_size))
+            if not examples:
+                return
+            yield range(start, start + len(examples)), None, examples
+            start += len(examples)
+
+    def _checkpoint_settings(self, chunk_size):
         """
-        matches = collections.defaultdict(list)
-        idxs, n_worker = args
-        matcher = OverlapyNgramMatcher(self.testset_ngrams)
+        Settings a checkpoint depends on: resuming with other settings would mix
+        incompatible partial results.
+        """
+        if self.index is not None:
+            testsets_hash = self.index.content_hash
+        else:
+            testsets_hash = OverlapyIndex.testsets_hash(self.testsets)
+        return {
+            "testsets": testsets_hash,
+            "results": self.results,
+            "vocabulary": self.vocabulary is not None,
+            "chunk_size": chunk_size,
+        }
 
-        for idx in tqdm(
-            idxs, total=len(idxs), position=n_worker + 1, desc=f"Worker #{n_worker}"
-        ):
-            matched = matcher([self.dataset[idx]])
-            for ngram, positions in matched.items():
-                matches[ngram].extend([idx] * len(positions))
-        return matches
+    @staticmethod
+    def _read_manifest(checkpoint_dir):
+        """
+        Reads the manifest of a checkpoint directory: a log of JSON lines, whose
+        first line holds the version and settings of the run, and each other line
+        the [start, stop, filename] entry of a finished work unit. A last line cut
+        short (by a crash while appending it) is dropped from the file.
+        """
+        path = os.path.join(checkpoint_dir, "manifest.jsonl")
+        with open(path, "rb+") as f:
+            data = f.read()
+            complete = data[: data.rfind(b"\n") + 1]
+            if len(complete) < len(data):
+                f.truncate(len(complete))
+        header, *shards = map(json.loads, complete.splitlines())
+        return dict(header, shards=shards)
+
+    def _load_manifest(self, checkpoint_dir, chunk_size):
+        """
+        Loads the manifest of a checkpoint directory, or creates an empty one.
+        """
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        settings = self._checkpoint_settings(chunk_size)
+        path = os.path.join(checkpoint_dir, "manifest.jsonl")
+        if not os.path.exists(path):
+            with open(path + ".tmp", "w") as fw:
+                fw.write(json.dumps({"version": 2, "settings": settings}) + "\n")
+            os.replace(path + ".tmp", path)
+            return {"version": 2, "settings": settings, "shards": []}
+        manifest = Overlapy._read_manifest(checkpoint_dir)
+        if manifest["settings"] != settings:
+            raise ValueError(
+                f"{checkpoint_dir} holds a checkpoint of a run with other settings"
+            )
+        return manifest
+
+    @staticmethod
+    def _append_manifest(checkpoint_dir, shard):
+        """
+        Records a finished work unit in the manifest, by appending one line to it.
+        """
+        with open(os.path.join(checkpoint_dir, "manifest.jsonl"), "a") as fw:
+            fw.write(json.dumps(shard) + "\n")
+
+    def merge_checkpoint(self, checkpoint_dir):
+        """
+        Streams the matches saved in a checkpoint directory (see run()), as (ngram, value)
+        pairs, sorted by (encoded) ngram. The shards are merged with a k-way merge,
+        so only one record per shard is held in memory. This is the way to consume the
+        results of runs too large for their matches to fit in memory, after
+        run(checkpoint_dir, merge=False).
+        """
+        manifest = Overlapy._read_manifest(checkpoint_dir)
+        shards = sorted(manifest["shards"])
+        paths = [os.path.join(checkpoint_dir, filename) for _, _, filename in shards]
+        for ngram, value in _merge_shards(paths):
+            if self.vocabulary is not None:
+                ngram = self.vocabulary.decode(ngram)
+            yield ngram, value
 
-    def run(self):
+    def run(self, checkpoint_dir=None, merge=True):
         """
         Calculates ngram matches between the supplied dataset and the testsets, in a parallel manner.
 
         A pool of workers is leveraged to calculate matches between different chunks of the dataset.
+        The matcher is built once, here, and handed to the workers through the pool initializer:
+        with the fork start method they inherit it copy-on-write, otherwise it is pickled once
+        per worker (never once per task).
+
+        After the run, worker_stats maps each worker's pid to the number of tasks,
+        examples and tokens it processed, the occurrences it matched, the time it spent
+        busy and its utilization (busy time over the duration of the run), and
+        phase_times holds the duration of each phase of the run.
+
+        When checkpoint_dir is given, the run can be resumed: each worker saves the
+        matches of each work unit to a shard file in that directory, and a manifest
+        keeps track of the finished work units, which are skipped when the run is
+        restarted with the same directory. Work units then default to
+        CHECKPOINT_CHUNK_SIZE examples. The result is merged from the shard files
+        into memory, unless merge is False: run() then returns None, and the matches
+        are streamed from the shard files with merge_checkpoint().
         """
-        pool = Pool(self.n_workers)
-        matches = collections.defaultdict(list)
+        chunk_size = self.chunk_size
+        manifest = None
+        if checkpoint_dir is not None:
+            if self.stop_after is not None and self.results == "documents":
+                raise ValueError(
+                    "Resumable runs with stop_after need occurrence or count results"
+                )
+            chunk_size = chunk_size or CHECKPOINT_CHUNK_SIZE
+            manifest = self._load_manifest(checkpoint_dir, chunk_size)
+
+        context = self._worker_context(checkpoint_dir)
+        if self.metrics is not None:
+            context.counters = _WorkerCounters(self.n_workers)
+        if context.query is not None and manifest is not None:
+            # Counts the matches of the finished work units again, so that the
+            # resumed run starts from the examples and ngrams they resolved.
+            context.query.update(
+                (ngram, value if isinstance(value, int) else len(value))
+                for ngram, value in _merge_shards(
+                    [
+                        os.path.join(checkpoint_dir, filename)
+                        for _, _, filename in manifest["shards"]
+                    ]
+                )
+            )
+        matches = RESULTS[self.results]()
 
-        for d in tqdm(
-            pool.imap_unordered(
-                self._calculate_chunk_matches,
-                zip(
-                    list_split(list(range(len(self.dataset))), self.n_workers),
-                    list(range(self.n_workers)),
+        # Keep the garbage collector from touching (and thus un-sharing) the pages
+        # holding the matcher in the forked workers.
+        gc.freeze()
+        try:
+            pool = Pool(self.n_workers, initializer=_init_worker, initargs=(context,))
+        finally:
+            gc.unfreeze()
+
+        tasks = self._tasks(chunk_size)
+        if manifest is not None:
+            done = {(start, stop) for start, stop, _ in manifest["shards"]}
+            tasks = (
+                task for task in tasks if (task[0].start, task[0].stop) not in done
+            )
+            if not self.streaming:
+                tasks = list(tasks)
+        self.worker_stats = {}
+        start = time.perf_counter()
+        last_emitted = start
+        merge_time = 0.0
+        queue_stats = {"pending": 0, "ready": 0}
+
+        def emit_progress():
+            # Called after each work unit, and periodically while waiting for one.
+            nonlocal last_emitted
+            now = time.perf_counter()
+            if now - last_emitted >= self.metrics_interval:
+                self.phase_times["scan"] = now - start
+                self._emit_metrics(
+                    "progress", now - start, queue_stats, context.counters
+                )
+                last_emitted = now
+
+        for d, worker in tqdm(
+            imap_bounded(
+                pool,
+                _calculate_chunk_matches,
+                tasks,
+                max_pending=2 * self.n_workers,
+                stats=queue_stats,
+                timeout=(
+                    None
+                    if self.metrics is None
+                    else max(self.metrics_interval / 4, 0.01)
                 ),
+                on_timeout=emit_progress,
             ),
-            total=self.n_workers,
+            total=None if self.streaming else len(tasks),
             position=0,
             desc="Global progress",
+            disable=not self.progress,
         ):
-            for ngram, positions in d.items():
-                matches[ngram].extend(positions)
+            now = time.perf_counter()
+            if manifest is None:
+                matches.update(d)
+            else:
+                manifest["shards"].append(d)
+                Overlapy._append_manifest(checkpoint_dir, d)
+            merge_time += time.perf_counter() - now
+            self._add_worker_stats(worker["pid"], worker)
+            if self.metrics is not None:
+                emit_progress()
 
         pool.close()
         pool.join()
 
-        return matches
+        start = self._finish_scan(start, context.prefilter)
+        if context.query is not None:
+            self.contaminated = context.query.contaminated(self.testsets)
+        if manifest is not None and merge:
+            paths = [
+                os.path.join(checkpoint_dir, filename)
+                for _, _, filename in sorted(manifest["shards"])
+            ]
+            for ngram, value in _merge_shards(paths):
+                matches.matches[ngram] = value
+        result = self._result(matches, start, merge_time, queue_stats)
+        return result if manifest is None or merge else None
+
+    def _worker_context(self, checkpoint_dir=None):
+        """
+        Builds the matcher, and the prefilter if any, and the state shared by the
+        workers of a run (see _WorkerContext).
+        """
+        phases = {"ngrams": self.phase_times["ngrams"]}
+        self.phase_times = phases
+        start = time.perf_counter()
+        if self.index is not None:
+            matcher = self.index.matcher(self.engine)
+            ngrams = self.index.ngrams()
+        else:
+            ngrams = self.testset_ngrams
+            if self.vocabulary is not None:
+                ngrams = {tuple(self.vocabulary.encode(ngram)) for ngram in ngrams}
+            matcher = ENGINES[self.engine](ngrams)
+        prefilter = None
+        if self.prefilter is not None:
+            prefilter = OverlapyBloomFilter(ngrams, self.prefilter)
+        phases["build"] = time.perf_counter() - start
+        encode = None
+        if isinstance(self.dataset, OverlapyTokenizedCorpus):
+            encode = self.dataset.translation(self.vocabulary)
+        elif self.vocabulary is not None:
+            encode = self.vocabulary.encode
+        query = None
+        if self.stop_after is not None:
+            query = _QueryState(
+                self.testsets,
+                self.vocabulary.encode if self.vocabulary is not None else None,
+                self.stop_after,
+            )
+        return _WorkerContext(
+            dataset=None if self.streaming else self.dataset,
+            matcher=matcher,
+            results=self.results,
+            encode=encode,
+            batch_size=self.batch_size,
+            prefilter=prefilter,
+            checkpoint_dir=checkpoint_dir,
+            progress=self.progress,
+            query=query,
+            dedup=_DedupCache(self.dedup_cache) if self.dedup_cache else None,
+        )
+
+    def _add_worker_stats(self, worker_id, worker):
+        """
+        Adds the stats of a finished work unit to those of the worker that ran it.
+        """
+        stats = self.worker_stats.setdefault(
+            worker_id,
+            {
+                "tasks": 0,
+                "examples": 0,
+                "tokens": 0,
+                "matches": 0,
+                "rejected": 0,
+                "duplicates": 0,
+                "busy": 0.0,
+            },
+        )
+        stats["tasks"] += 1
+        for key in ("examples", "tokens", "matches", "rejected", "duplicates", "busy"):
+            stats[key] += worker[key]
+
+    def _finish_scan(self, start, prefilter):
+        """
+        Completes the stats of the workers, of the prefilter and of the dedup cache
+        once the scan, which started at start, is over. Returns the time at which the
+        merge starts.
+        """
+        elapsed = time.perf_counter() - start
+        self.phase_times["scan"] = elapsed
+        for stats in self.worker_stats.values():
+            stats["utilization"] = stats["busy"] / elapsed if elapsed else 1.0
+        if prefilter is not None:
+            n_examples = sum(stats["examples"] for stats in self.worker_stats.values())
+            n_rejected = sum(stats["rejected"] for stats in self.worker_stats.values())
+            self.prefilter_stats = {
+                "build_time": prefilter.build_time,
+                "size": len(prefilter),
+                "n_hashes": prefilter.n_hashes,
+                "examples": n_examples,
+                "rejected": n_rejected,
+                "rejection_rate": n_rejected / n_examples if n_examples else 0.0,
+            }
+        if self.dedup_cache is not None:
+            n_examples = sum(stats["examples"] for stats in self.worker_stats.values())
+            n_hits = sum(stats["duplicates"] for stats in self.worker_stats.values())
+            self.dedup_stats = {
+                "size": self.dedup_cache,
+                "lookups": n_examples,
+                "hits": n_hits,
+                "hit_rate": n_hits / n_examples if n_examples else 0.0,
+            }
+        return time.perf_counter()
+
+    def _result(self, matches, start, merge_time, queue_stats):
+        """
+        Decodes the merged matches, and emits the final metrics of the run.
+        """
+        if self.vocabulary is not None:
+            result = matches.result(self.vocabulary.decode)
+        else:
+            result = matches.result()
+        self.phase_times["merge"] = merge_time + time.perf_counter() - start
+        if self.metrics is not None:
+            self._emit_metrics("done", self.phase_times["scan"], queue_stats)
+        return result
+
+    def _emit_metrics(self, event, elapsed, queue_stats, counters=None):
+        """
+        Hands a metrics record of the run (see __init__()) to the metrics callable or file.
+        The progress of the workers is read from counters, when given, which includes
+        the work units they are running, otherwise from the finished work units.
+        """
+        workers = {pid: dict(stats) for pid, stats in self.worker_stats.items()}
+        if counters is not None:
+            for pid, progress in counters.snapshot().items():
+                workers.setdefault(pid, {"tasks": 0}).update(progress)
+        totals = {
+            key: sum(stats[key] for stats in workers.values())
+            for key in ("examples", "tokens", "matches")
+        }
+        record = {
+            "event": event,
+            "time": time.time(),
+            "elapsed": elapsed,
+            **totals,
+            "examples_per_second": totals["examples"] / elapsed if elapsed else 0.0,
+            "tokens_per_second": totals["tokens"] / elapsed if elapsed else 0.0,
+            "phases": dict(self.phase_times),
+            "tasks_pending": queue_stats["pending"],
+            "tasks_ready": queue_stats["ready"],
+            "workers": {
+                str(pid): {
+                    "tasks": stats["tasks"],
+                    "examples": stats["examples"],
+                    "busy": stats["busy"],
+                    "examples_per_second": (
+                        stats["examples"] / stats["busy"] if stats["busy"] else 0.0
+                    ),
+                    "tokens_per_second": (
+                        stats["tokens"] / stats["busy"] if stats["busy"] else 0.0
+                    ),
+                }
+                for pid, stats in workers.items()
+            },
+        }
+        self.last_metrics = record
+        if callable(self.metrics):
+            self.metrics(record)
+        else:
+            self.metrics.write(json.dumps(record) + "\n")
+            self.metrics.flush()
+
+
+ENGINES = {
+    "aho-corasick": OverlapyNgramMatcher,
+    "rolling-hash": OverlapyHashMatcher,
+    "numpy": OverlapyNumpyMatcher,
+}
+
+
+class _OccurrenceResults:
+    """
+    Accumulates, for each ngram, the dataset index of every occurrence.
+    """
+
+    def __init__(self):
+        self.matches = collections.defaultdict(list)
+
+    def add(self, ngram, idx, count):
+        self.matches[ngram].extend([idx] * count)
+
+    def update(self, matches):
+        for ngram, idxs in matches.items():
+            self.matches[ngram].extend(idxs)
+
+    def result(self, decode=None):
+        if decode is None:
+            return self.matches
+        return collections.defaultdict(
+            list, ((decode(ngram), idxs) for ngram, idxs in self.matches.items())
+        )
+
+
+class _DocumentResults:
+    """
+    Accumulates, for each ngram, the distinct dataset indexes it occurs in.
+
+    Indexes are added in increasing order within a work unit and work units cover
+    disjoint ranges of the dataset, so deduplicating against the last index suffices,
+    and merging only needs a final sort.
+    """
+
+    def __init__(self):
+        self.matches = {}
+
+    def add(self, ngram, idx, count):
+        idxs = self.matches.get(ngram)
+        if idxs is None:
+            self.matches[ngram] = array("I", [idx])
+        elif idxs[-1] != idx:
+            idxs.append(idx)
+
+    def update(self, matches):
+        for ngram, idxs in matches.items():
+            if ngram in self.matches:
+                self.matches[ngram].extend(idxs)
+            else:
+                self.matches[ngram] = idxs
+
+    def result(self, decode=None):
+        return {
+            ngram if decode is None else decode(ngram): array("I", sorted(idxs))
+            for ngram, idxs in self.matches.items()
+        }
+
+
+class _CountResults:
+    """
+    Accumulates, for each ngram, its number of occurrences.
+    """
+
+    def __init__(self):
+        self.matches = collections.defaultdict(int)
+
+    def add(self, ngram, idx, count):
+        self.matches[ngram] += count
+
+    def update(self, matches):
+        for ngram, count in matches.items():
+            self.matches[ngram] += count
+
+    def result(self, decode=None):
+        if decode is None:
+            return self.matches
+        return collections.defaultdict(
+            int, ((decode(ngram), count) for ngram, count in self.matches.items())
+        )
+
+
+RESULTS = {
+    "occurrences": _OccurrenceResults,
+    "documents": _DocumentResults,
+    "counts": _CountResults,
+}
+
+
+class _WorkerContext:
+    """
+    State shared by every worker of a run: the dataset, the prebuilt matcher,
+    the representation of the results, the function encoding examples as token ids
+    and the prefilter, if any, the number of examples to match at once, the
+    checkpoint directory, if any, whether to show progress bars, the state of
+    the ngrams and examples resolved so far when stop_after is set, the dedup
+    cache, if any, and the counters the workers publish their progress to, when
+    metrics are collected (see Overlapy).
+    """
+
+    def __init__(
+        self,
+        dataset,
+        matcher,
+        results,
+        encode=None,
+        batch_size=MATCH_BATCH_SIZE,
+        prefilter=None,
+        checkpoint_dir=None,
+        progress=True,
+        query=None,
+        dedup=None,
+        counters=None,
+    ):
+        self.dataset = dataset
+        self.matcher = matcher
+        self.results = results
+        self.encode = encode
+        self.batch_size = batch_size
+        self.prefilter = prefilter
+        self.checkpoint_dir = checkpoint_dir
+        self.progress = progress
+        self.query = query
+        self.dedup = dedup
+        self.counters = counters
+
+
+class _WorkerCounters:
+    """
+    Progress of the workers of a run, in shared memory, so that metrics can be
+    reported while work units are still running (see Overlapy). Each worker takes
+    a slot on its first update, where it adds the examples, tokens and matches it
+    processes and the time it spends busy, batch after batch.
+    """
+
+    FIELDS = ("examples", "tokens", "matches", "busy")
+
+    def __init__(self, n_workers):
+        self.values = RawArray("d", len(self.FIELDS) * n_workers)
+        self.pids = RawArray("q", n_workers)
+        self.n_slots = RawValue("I", 0)
+        self.lock = Lock()
+        # slot of this process, once it has one
+        self.slot = None
+
+    def add(self, *values):
+        if self.slot is None:
+            with self.lock:
+                self.slot = self.n_slots.value
+                if self.slot < len(self.pids):
+                    self.pids[self.slot] = os.getpid()
+                    self.n_slots.value += 1
+        if self.slot < len(self.pids):
+            base = len(self.FIELDS) * self.slot
+            for i, value in enumerate(values):
+                self.values[base + i] += value
+
+    def snapshot(self):
+        """
+        Returns the progress of each worker, by pid, as a dict of FIELDS.
+        """
+        n = len(self.FIELDS)
+        snapshot = {}
+        for slot in range(self.n_slots.value):
+            examples, tokens, matches, busy = self.values[n * slot : n * (slot + 1)]
+            snapshot[self.pids[slot]] = {
+                "examples": int(examples),
+                "tokens": int(tokens),
+                "matches": int(matches),
+                "busy": busy,
+            }
+        return snapshot
+
+
+class _QueryState:
+    """
+    Ngrams and testset examples resolved by a run with stop_after (see Overlapy),
+    in shared memory, so that every worker sees what the others have resolved.
+
+    Ngrams are numbered in the form the matcher outputs them (as token ids, if
+    encoded), and examples are numbered across testsets. resolved lists the ngram
+    numbers in the order they were resolved, which lets each worker discard the
+    ones resolved since it last looked, without scanning every ngram.
+    """
+
+    def __init__(self, testsets, encode, stop_after):
+        self.stop_after = stop_after
+        self.ids = {}
+        self.ngrams = []
+        self.owners = []
+        self.example_ngrams = []
+        for testset in testsets:
+            base = len(self.example_ngrams)
+            self.example_ngrams.extend([] for _ in range(len(testset)))
+            for ngram, occurrences in testset.ngram_index().items():
+                if encode is not None:
+                    ngram = tuple(encode(ngram))
+                ngram_id = self.ids.get(ngram)
+                if ngram_id is None:
+                    ngram_id = self.ids[ngram] = len(self.ngrams)
+                    self.ngrams.append(ngram)
+                    self.owners.append([])
+                for i in sorted({i for i, _ in occurrences}):
+                    self.owners[ngram_id].append(base + i)
+                    self.example_ngrams[base + i].append(ngram_id)
+        self.counts = RawArray("I", len(self.ngrams))
+        self.is_resolved = RawArray("B", len(self.ngrams))
+        self.resolved = RawArray("I", len(self.ngrams))
+        self.n_resolved = RawValue("Q", 0)
+        self.dirty = RawArray("B", len(self.example_ngrams))
+        self.lock = Lock()
+        # number of resolved ngrams discarded by this process' matcher
+        self.cursor = 0
+
+    def update(self, counts):
+        """
+        Counts the occurrences of the matched ngrams, given as (ngram, count) pairs,
+        and resolves those seen stop_after times, the examples they occur in, and
+        the ngrams which only occur in resolved examples.
+        """
+        with self.lock:
+            for ngram, count in counts:
+                # str examples are matched as str, but numbered as tuples
+                ngram_id = self.ids.get(tuple(ngram))
+                if ngram_id is None or self.is_resolved[ngram_id]:
+                    continue
+                count = self.counts[ngram_id] + count
+                self.counts[ngram_id] = min(count, 0xFFFFFFFF)
+                if count < self.stop_after:
+                    continue
+                self._resolve(ngram_id)
+                for example in self.owners[ngram_id]:
+                    if self.dirty[example]:
+                        continue
+                    self.dirty[example] = 1
+                    for other in self.example_ngrams[example]:
+                        if not self.is_resolved[other] and all(
+                            self.dirty[owner] for owner in self.owners[other]
+                        ):
+                            self._resolve(other)
+
+    def _resolve(self, ngram_id):
+        self.is_resolved[ngram_id] = 1
+        self.resolved[self.n_resolved.value] = ngram_id
+        self.n_resolved.value += 1
+
+    def prune(self, matcher):
+        """
+        Discards from the matcher the ngrams resolved since the last call.
+        """
+        with self.lock:
+            n_resolved = self.n_resolved.value
+        if n_resolved > self.cursor:
+            ngram_ids = self.resolved[self.cursor : n_resolved]
+            matcher.discard([self.ngrams[ngram_id] for ngram_id in ngram_ids])
+            self.cursor = n_resolved
+
+    def contaminated(self, testsets):
+        result = {}
+        base = 0
+        for testset in testsets:
+            result[testset.name] = [
+                i for i in range(len(testset)) if self.dirty[base + i]
+            ]
+            base += len(testset)
+        return result
+
+
+_context = None
+
+
+def _init_worker(context):
+    global _context
+    _context = context
+
+
+def _calculate_chunk_matches(args):
+    """
+    Calculates matches between the testset ngrams and a chunk of the given dataset.
+
+    This function is executed by each worker from a pool of workers (processes).
+    Besides the matches, it returns the worker's pid, the time spent, the number of
+    examples and tokens processed, the number of occurrences matched, the number
+    of examples rejected by the prefilter and the number of duplicate examples
+    found in the dedup cache.
+    In checkpointed runs, the matches are saved to a shard file instead, and the
+    (start, stop, filename) entry of the manifest is returned in their place.
+    """
+    start = time.perf_counter()
+    matches = RESULTS[_context.results]()
+    idxs, n_worker, examples = args
+    n_rejected = 0
+    n_tokens = 0
+    n_matches = 0
+    n_hits = _context.dedup.hits if _context.dedup is not None else 0
+
+    batches = [
+        range(i, min(i + _context.batch_size, len(idxs)))
+        for i in range(0, len(idxs), _context.batch_size)
+    ]
+    if n_worker is not None and _context.progress:
+        batches = tqdm(
+            batches,
+            total=len(batches),
+            position=n_worker + 1,
+            desc=f"Worker #{n_worker}",
+        )
+    for batch in batches:
+        batch_start = time.perf_counter()
+        batch_tokens, batch_matches = n_tokens, n_matches
+        if _context.query is not None:
+            _context.query.prune(_context.matcher)
+        if examples is None:
+            batch_examples = [_context.dataset[idxs[i]] for i in batch]
+        else:
+            batch_examples = examples[batch.start : batch.stop]
+        if _context.encode is not None:
+            batch_examples = list(map(_context.encode, batch_examples))
+        n_tokens += sum(map(len, batch_examples))
+        if _context.dedup is not None:
+            found, rejected = _context.dedup.match(batch_examples, _match_batch)
+        else:
+            found, rejected = _match_batch(batch_examples)
+        n_rejected += rejected
+        if _context.query is not None:
+            _context.query.update(
+                (ngram, len(positions)) for ngram, positions in found.items()
+            )
+        for ngram, positions in found.items():
+            n_matches += len(positions)
+            for i, occurrences in groupby(positions):
+                matches.add(ngram, idxs[batch[i]], len(list(occurrences)))
+        if _context.counters is not None:
+            _context.counters.add(
+                len(batch),
+                n_tokens - batch_tokens,
+                n_matches - batch_matches,
+                time.perf_counter() - batch_start,
+            )
+    stats = {
+        "pid": os.getpid(),
+        "busy": time.perf_counter() - start,
+        "examples": len(idxs),
+        "tokens": n_tokens,
+        "matches": n_matches,
+        "rejected": n_rejected,
+        "duplicates": 0,
+    }
+    if _context.dedup is not None:
+        stats["duplicates"] = _context.dedup.hits - n_hits
+    if _context.checkpoint_dir is None:
+        return matches.matches, stats
+    filename = f"shard-{idxs.start:012d}-{idxs.stop:012d}.pkl"
+    _write_shard(os.path.join(_context.checkpoint_dir, filename), matches.matches)
+    return [idxs.start, idxs.stop, filename], stats
+
+
+def _match_batch(examples):
+    """
+    Matches a batch of examples, through the prefilter if any. Returns the matches,
+    as positions of the examples in the batch, and the number of examples rejected.
+    """
+    if _context.prefilter is None:
+        return _context.matcher(examples), 0
+    candidates = _context.prefilter.candidates(examples)
+    found = _context.matcher([examples[i] for i in candidates])
+    for ngram, positions in found.items():
+        found[ngram] = [candidates[i] for i in positions]
+    return found, len(examples) - len(candidates)
+
+
+class _DedupCache:
+    """
+    Cache of the matches of examples by content hash, so that duplicate examples
+    are matched only once (see Overlapy's dedup_cache).
+
+    Most examples match nothing: their hashes are kept in a direct-mapped table in
+    shared memory, where each hash evicts the one in its slot, so that a duplicate
+    of an example matched by any worker is skipped. The matches of the other
+    examples are kept by each worker, in a dictionary evicting the least recently
+    used entry beyond size entries.
+
+    Hashes have 128 bits, so that a collision, which would give an example the
+    matches of another, stays negligible over billions of examples. They take two
+    slots of the table: the low and the high 64 bits.
+    """
+
+    def __init__(self, size):
+        assert size >= 1
+        self.size = size
+        self.no_matches = RawArray("Q", 2 * size)
+        self.matches = collections.OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(example):
+        try:
+            data = memoryview(example).cast("B")
+        except TypeError:
+            data = "\x00".join(map(str, example)).encode()
+        # 0 marks the empty slots of the table
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def _has_no_matches(self, key):
+        slot = 2 * (key % self.size)
+        return (
+            self.no_matches[slot] == key & 0xFFFFFFFFFFFFFFFF
+            and self.no_matches[slot + 1] == key >> 64
+        )
+
+    def _set_no_matches(self, key):
+        # Unlocked: a torn entry mixes the halves of two hashes, which is as
+        # unlikely to match an example as a collision.
+        slot = 2 * (key % self.size)
+        self.no_matches[slot] = key & 0xFFFFFFFFFFFFFFFF
+        self.no_matches[slot + 1] = key >> 64
+
+    def match(self, examples, match):
+        """
+        Matches a batch of examples like match() (see _match_batch()), which is only
+        called on the examples missing from the cache.
+        """
+        keys = list(map(self.key, examples))
+        self.lookups += len(examples)
+        found = collections.defaultdict(list)
+        misses = {}
+        for j, key in enumerate(keys):
+            cached = None
+            if self._has_no_matches(key):
+                cached = ()
+            elif key in self.matches:
+                cached = self.matches[key]
+                self.matches.move_to_end(key)
+            if cached is not None:
+                self.hits += 1
+                for ngram, count in cached:
+                    found[ngram].extend(repeat(j, count))
+            else:
+                misses.setdefault(key, []).append(j)
+        n_rejected = 0
+        if misses:
+            firsts = [js[0] for js in misses.values()]
+            new, n_rejected = match([examples[j] for j in firsts])
+            results = collections.defaultdict(list)
+            for ngram, positions in new.items():
+                for i, occurrences in groupby(positions):
+                    results[i].append((ngram, len(list(occurrences))))
+            for i, js in enumerate(misses.values()):
+                key = keys[js[0]]
+                if i not in results:
+                    self._set_no_matches(key)
+                    continue
+                self.matches[key] = results[i]
+                if len(self.matches) > self.size:
+                    self.matches.popitem(last=False)
+                for ngram, count in results[i]:
+                    for j in js:
+                        found[ngram].extend(repeat(j, count))
+            # duplicates within the batch
+            self.hits += sum(len(js) - 1 for js in misses.values())
+        for positions in found.values():
+            positions.sort()
+        return found, n_rejected
+
+
+def _write_shard(path, matches):
+    """
+    Writes matches to a shard file, as a sequence of pickled (ngram, value) records
+    sorted by ngram, so that shards can be merged as streams (see _merge_shards()).
+    """
+    with open(path + ".tmp", "wb") as fw:
+        for record in sorted(matches.items()):
+            pickle.dump(record, fw, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def _read_shard(path):
+    with open(path, "rb") as fr:
+        while True:
+            try:
+                yield pickle.load(fr)
+            except EOFError:
+                return
+
+
+def _merge_shards(paths):
+    """
+    K-way merge of shard files: yields (ngram, value) sorted by ngram, where the values
+    of the same ngram in different shards are concatenated (lists and arrays, in the
+    order of the paths) or added (counts).
+    """
+    merged = heapq.merge(*map(_read_shard, paths), key=lambda record: record[0])
+    for ngram, records in groupby(merged, key=lambda record: record[0]):
+        _, value = next(records)
+        if isinstance(value, int):
+            value += sum(other for _, other in records)
+        else:
+            # extended in place: concatenating would copy the values merged so far
+            value = value[:]
+            for _, other in records:
+                value.extend(other)
+        yield ngram, value
+
+
+class OverlapyCoordinator:
+    """
+    Coordinates a scan distributed over worker processes, possibly on other hosts,
+    which connect to it over TCP (see run_worker()).
+
+    The coordinator builds the matcher of an Overlapy instance and sends it, along
+    with the dataset, to each worker that connects. It then hands out work units of
+    chunk_size examples (ranges of dataset indexes, along with their examples when
+    streaming) to whichever worker asks for one. Workers send back the matches of each
+    work unit as a compressed pickle of the compact results (see Overlapy), which the
+    coordinator merges. When a worker fails (it disconnects, or does not answer within
+    task_timeout seconds), its work unit is handed to another worker; a work unit that
+    fails max_attempts times fails the run.
+
+    Random access datasets are pickled to every worker, so they should be cheap to
+    pickle, e.g. an OverlapyTokenizedCorpus on storage shared by the hosts.
+    The connections are authenticated with authkey, which is random by default.
+
+        coordinator = OverlapyCoordinator(overlapy, ("0.0.0.0", 5000), authkey=b"secret")
+        matches = coordinator.run()
+
+    while, on each host:
+
+        run_worker(("coordinator-host", 5000), authkey=b"secret")
+    """
+
+    def __init__(
+        self,
+        overlapy,
+        address=("localhost", 0),
+        authkey=None,
+        chunk_size=None,
+        task_timeout=None,
+        max_attempts=3,
+    ):
+        self.overlapy = overlapy
+        self.authkey = authkey if authkey is not None else os.urandom(32)
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        host, port = self.address
+        if host in ("", "0.0.0.0"):
+            host = "localhost"
+        self.local_address = (host, port)
+        self.chunk_size = chunk_size or overlapy.chunk_size or CHECKPOINT_CHUNK_SIZE
+        self.task_timeout = task_timeout
+        self.max_attempts = max_attempts
+        self.n_failures = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def run(self, n_local_workers=0):
+        """
+        Runs the scan and returns its matches, like Overlapy.run(). The worker_stats
+        of the Overlapy instance are keyed by the "host:pid" of each worker.
+        n_local_workers worker processes are started on this host; other workers
+        may connect at any time until the run is over.
+        """
+        overlapy = self.overlapy
+        if overlapy.stop_after is not None or overlapy.dedup_cache is not None:
+            # their state lives in memory shared by the workers of one host
+            raise ValueError(
+                "Distributed scans support neither stop_after nor dedup_cache"
+            )
+        context = overlapy._worker_context()
+        self._payload = pickle.dumps(context, pickle.HIGHEST_PROTOCOL)
+        self._tasks = iter(overlapy._tasks(self.chunk_size))
+        self._retries = collections.deque()
+        self._attempts = collections.Counter()
+        self._in_flight = 0
+        self._exhausted = False
+        self._results = queue.Queue()
+
+        # Fork the local workers before starting any thread.
+        workers = [
+            Process(target=run_worker, args=(self.local_address, self.authkey))
+            for _ in range(n_local_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+        matches = RESULTS[overlapy.results]()
+        overlapy.worker_stats = {}
+        start = time.perf_counter()
+        last_emitted = start
+        merge_time = 0.0
+        queue_stats = {"pending": 0, "ready": 0}
+        try:
+            while True:
+                with self._condition:
+                    finished = (
+                        self._exhausted and not self._in_flight and not self._retries
+                    )
+                try:
+                    host, data = self._results.get(timeout=0.1)
+                except queue.Empty:
+                    if finished:
+                        break
+                else:
+                    if host is None:
+                        raise data
+                    now = time.perf_counter()
+                    d, worker = pickle.loads(zlib.decompress(data))
+                    matches.update(d)
+                    merge_time += time.perf_counter() - now
+                    overlapy._add_worker_stats(f"{host}:{worker['pid']}", worker)
+                # Metrics are emitted on time, even while no work unit finishes.
+                now = time.perf_counter()
+                queue_stats = {
+                    "pending": self._in_flight,
+                    "ready": self._results.qsize(),
+                }
+                if (
+                    overlapy.metrics is not None
+                    and now - last_emitted >= overlapy.metrics_interval
+                ):
+                    overlapy.phase_times["scan"] = now - start
+                    overlapy._emit_metrics("progress", now - start, queue_stats)
+                    last_emitted = now
+        finally:
+            self.close()
+            for worker in workers:
+                worker.join()
+
+        start = overlapy._finish_scan(start, context.prefilter)
+        return overlapy._result(matches, start, merge_time, queue_stats)
+
+    def close(self):
+        """
+        Stops accepting workers.
+        """
+        if self._closed:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        try:
+            # wake up the thread blocked in accept()
+            socket.create_connection(self.local_address).close()
+        except OSError:
+            pass
+        self.listener.close()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            if self._closed:
+                conn.close()
+                return
+            host = self.listener.last_accepted[0]
+            threading.Thread(target=self._serve, args=(conn, host), daemon=True).start()
+
+    def _serve(self, conn, host):
+        """
+        Serves a worker: sends it the worker context, then work units until none are
+        left, and queues the matches it sends back.
+        """
+        task = None
+        try:
+            conn.send_bytes(self._payload)
+            while True:
+                task = self._next_task()
+                conn.send(task)
+                if task is None:
+                    return
+                if self.task_timeout is not None and not conn.poll(self.task_timeout):
+                    raise TimeoutError
+                self._results.put((host, conn.recv_bytes()))
+                # only once the matches are queued (see run())
+                self._task_done()
+                task = None
+        except (OSError, EOFError):
+            if task is not None:
+                self._task_failed(task)
+        finally:
+            conn.close()
+
+    def _next_task(self):
+        """
+        Returns the next work unit to hand out (failed ones first), or None when every
+        work unit is done. Waits while the remaining work units are in flight, as they
+        may fail.
+        """
+        with self._condition:
+            while True:
+                if self._retries:
+                    task = self._retries.popleft()
+                elif not self._exhausted:
+                    task = next(self._tasks, None)
+                    self._exhausted = task is None
+                else:
+                    task = None
+                if task is not None:
+                    self._in_flight += 1
+                    return task
+                if not self._in_flight or self._closed:
+                    return None
+                self._condition.wait()
+
+    def _task_done(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _task_failed(self, task):
+        with self._condition:
+            self.n_failures += 1
+            idxs = task[0]
+            self._attempts[idxs.start, idxs.stop] += 1
+            if self._attempts[idxs.start, idxs.stop] >= self.max_attempts:
+                error = RuntimeError(
+                    f"Work unit {idxs.start}-{idxs.stop} failed {self.max_attempts} times"
+                )
+                self._results.put((None, error))
+            else:
+                self._retries.append(task)
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+def run_worker(address, authkey):
+    """
+    Runs a worker of a distributed scan (see OverlapyCoordinator): connects to the
+    coordinator at address, then matches the work units it hands out until there
+    are none left.
+    """
+    with Client(address, authkey=authkey) as conn:
+        _init_worker(pickle.loads(conn.recv_bytes()))
+        while True:
+            task = conn.recv()
+            if task is None:
+                return
+            result = _calculate_chunk_matches(task)
+            conn.send_bytes(
+                zlib.compress(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+            )
+
+
+def token_hash(token):
+    """
+    Stable 64-bit hash of a token: unlike hash(), it is the same in every process.
+    """
+    digest = hashlib.blake2b(str(token).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _dataset_chunks(dataset, chunk_size):
+    """
+    Splits a dataset into work units of chunk_size examples: (dataset indexes, examples),
+    where examples are only given for datasets without random access.
+    """
+    if hasattr(dataset, "__len__") and hasattr(dataset, "__getitem__"):
+        for start in range(0, len(dataset), chunk_size):
+            yield range(start, min(start + chunk_size, len(dataset))), None
+        return
+    iterator = iter(dataset)
+    start = 0
+    while True:
+        examples = list(islice(iterator, chunk_size))
+        if not examples:
+            return
+        yield range(start, start + len(examples)), examples
+        start += len(examples)
+
+
+class OverlapyCorpusSummary:
+    """
+    Persisted summary of the ngrams of a pretraining dataset, against which testsets
+    can be checked without scanning the dataset again.
+
+    For each ngram size, it holds the set of the fingerprints of the dataset's ngrams.
+    Fingerprints are computed over stable token hashes (see token_hash()), so they do
+    not depend on a vocabulary. The summary is sharded by work unit: each shard has
+    one file per ngram size, a sorted array of unique fingerprints, which is
+    memory-mapped and binary searched at query time. A manifest keeps track of the
+    finished shards, so an interrupted build can be resumed.
+
+    Since only fingerprints are kept, two distinct ngrams may collide, but with 64-bit
+    fingerprints the odds are negligible even for billions of ngrams.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as fr:
+            manifest = json.load(fr)
+        self.sizes = manifest["sizes"]
+        self.shards = sorted(manifest["shards"])
+
+    @classmethod
+    def build(
+        cls,
+        dataset,
+        path,
+        sizes=range(8, 14),
+        n_workers=cpu_count(),
+        chunk_size=CHECKPOINT_CHUNK_SIZE,
+    ):
+        """
+        Scans the dataset (sequences of tokens, with or without random access) in a pool
+        of workers and saves its summary to the directory path. Shards already in the
+        directory, from an interrupted build with the same sizes, are skipped.
+        """
+        sizes = sorted(sizes)
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, "manifest.json")
+        manifest = {"sizes": sizes, "shards": []}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fr:
+                manifest = json.load(fr)
+            if manifest["sizes"] != sizes:
+                raise ValueError(f"{path} holds a summary of other ngram sizes")
+        done = {tuple(shard) for shard in manifest["shards"]}
+        tasks = (
+            task
+            for task in _dataset_chunks(dataset, chunk_size)
+            if (task[0].start, task[0].stop) not in done
+        )
+
+        random_access = hasattr(dataset, "__len__") and hasattr(dataset, "__getitem__")
+        context = _SummaryContext(dataset if random_access else None, sizes, path)
+        with Pool(n_workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for shard in tqdm(
+                imap_bounded(pool, _summarize_chunk, tasks, max_pending=2 * n_workers),
+                desc="Summarizing",
+            ):
+                manifest["shards"].append(shard)
+                with open(manifest_path + ".tmp", "w") as fw:
+                    json.dump(manifest, fw)
+                os.replace(manifest_path + ".tmp", manifest_path)
+        return cls(path)
+
+    def _shard_fingerprints(self, start, stop, n):
+        path = os.path.join(self.path, _summary_filename(start, stop, n))
+        return memoryview(_map_file(path)).cast("Q")
+
+    def count(self, ngrams):
+        """
+        Returns, for each ngram (a sequence of tokens), the number of shards it occurs in.
+        """
+        counts = [0] * len(ngrams)
+        by_size = collections.defaultdict(list)
+        for i, ngram in enumerate(ngrams):
+            by_size[len(ngram)].append(i)
+        for n, idxs in by_size.items():
+            if n not in self.sizes:
+                raise ValueError(f"The summary holds no ngrams of size {n}")
+            queries = [fingerprint(map(token_hash, ngrams[i])) for i in idxs]
+            for start, stop in self.shards:
+                shard = self._shard_fingerprints(start, stop, n)
+                if not len(shard):
+                    continue
+                if np is not None:
+                    shard = np.frombuffer(shard, dtype=np.uint64)
+                    q = np.array(queries, dtype=np.uint64)
+                    found = shard[np.minimum(np.searchsorted(shard, q), len(shard) - 1)]
+                    hits = np.flatnonzero(found == q).tolist()
+                else:
+                    hits = []
+                    for j, h in enumerate(queries):
+                        k = bisect.bisect_left(shard, h)
+                        if k < len(shard) and shard[k] == h:
+                            hits.append(j)
+                for j in hits:
+                    counts[idxs[j]] += 1
+        return counts
+
+    def query(self, testsets):
+        """
+        Checks testsets against the summary. The output follows the structure of
+        Overlapy.run(), with the number of shards each ngram occurs in as value,
+        and can be handed to OverlapyTestSet.get_matches().
+        """
+        ngrams = list(
+            set(map(tuple, chain(*[list(testset.ngrams()) for testset in testsets])))
+        )
+        return {
+            ngram: count for ngram, count in zip(ngrams, self.count(ngrams)) if count
+        }
+
+
+def _summary_filename(start, stop, n):
+    return f"shard-{start:012d}-{stop:012d}.{n}.bin"
+
+
+class _SummaryContext:
+    """
+    State shared by every worker building an OverlapyCorpusSummary.
+    """
+
+    def __init__(self, dataset, sizes, path):
+        self.dataset = dataset
+        self.sizes = sizes
+        self.path = path
+        self.token_hashes = {}
+
+
+def _summarize_chunk(args):
+    """
+    Computes the fingerprints of the ngrams of a chunk of the dataset and saves them,
+    one file per ngram size. Executed by the workers of OverlapyCorpusSummary.build().
+    """
+    idxs, examples = args
+    if examples is None:
+        examples = [_context.dataset[idx] for idx in idxs]
+    cache = _context.token_hashes
+    hashed = []
+    for example in examples:
+        hashes = []
+        for token in example:
+            h = cache.get(token)
+            if h is None:
+                h = cache[token] = token_hash(token)
+            hashes.append(h)
+        hashed.append(hashes)
+
+    if np is not None:
+        tokens, example_of = _concatenate(hashed)
+    for n in _context.sizes:
+        if np is not None:
+            fingerprints, within = _window_fingerprints(tokens, example_of, n)
+            data = np.unique(fingerprints[within]).tobytes()
+        else:
+            fingerprints = {
+                h for hashes in hashed for _, h in rolling_fingerprints(hashes, n)
+            }
+            data = array("Q", sorted(fingerprints)).tobytes()
+        path = os.path.join(_context.path, _summary_filename(idxs.start, idxs.stop, n))
+        with open(path + ".tmp", "wb") as fw:
+            fw.write(data)
+        os.replace(path + ".tmp", path)
+    return [idxs.start, idxs.stop]
+
+
+class OverlapyMinHash:
+    """
+    Approximate engine finding the documents of a pretraining dataset which are near
+    duplicates of testset examples (e.g. lightly paraphrased or re-punctuated copies),
+    which exact ngram matching misses.
+
+    Each testset example is represented by its shingles, its ngrams of size N (see
+    OverlapyTestSet.compute_n()), and summarized by a MinHash signature of
+    bands * rows values. The fraction of values on which two signatures agree
+    estimates the Jaccard similarity of the two sets of shingles. Examples are indexed
+    by the hash of each band of rows values of their signature (locality sensitive
+    hashing), and documents whose signature agrees with an example's on all the rows
+    of some band are candidates. A pair of similarity s is found with probability
+    1 - (1 - s ** rows) ** bands: more rows per band cut the candidates of low
+    similarity, more bands raise the recall.
+
+    Tokens are hashed with token_hash() and shingles are fingerprinted as in
+    OverlapyCorpusSummary, so documents are sequences of tokens, like the testset
+    examples. Signatures are computed with vectorized operations, so numpy is required.
+    """
+
+    def __init__(self, testsets, bands=20, rows=5, seed=0):
+        if np is None:
+            raise ImportError("OverlapyMinHash requires numpy")
+        assert bands >= 1 and rows >= 1
+        self.bands = bands
+        self.rows = rows
+        # Each MinHash value is the minimum of a * h + b (mod 2**64) over the mixed
+        # fingerprints h of the shingles, with a odd so that it is a permutation.
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 64, bands * rows, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 64, bands * rows, dtype=np.uint64)
+        self.names = [testset.name for testset in testsets]
+        self.sizes = sorted({testset.compute_n() for testset in testsets})
+        # tables[band] maps (N, hash of the band) to (testset, example) pairs.
+        self.signatures = []
+        self.tables = [collections.defaultdict(list) for _ in range(bands)]
+        for t, testset in enumerate(testsets):
+            n = testset.compute_n()
+            signatures, valid = self.signatures_of(testset.examples, n)
+            self.signatures.append(signatures)
+            keys = self._band_keys(signatures)
+            for i in np.flatnonzero(valid).tolist():
+                for band, key in enumerate(keys[i].tolist()):
+                    self.tables[band][n, key].append((t, i))
+
+    def signatures_of(self, examples, n):
+        """
+        Returns the MinHash signatures of the examples, one per row, with shingles of
+        n tokens, and a mask of the examples which have any shingle.
+        """
+        tokens, example_of = _concatenate(
+            [list(map(_cached_token_hash, example)) for example in examples]
+        )
+        hashes, within = _window_fingerprints(tokens, example_of, n)
+        owners = example_of[: len(hashes)][within]
+        hashes = _mix64(hashes[within])
+        signatures = np.full(
+            (len(examples), self.bands * self.rows),
+            np.iinfo(np.uint64).max,
+            dtype=np.uint64,
+        )
+        for start in range(0, len(hashes), MINHASH_CHUNK_SIZE):
+            chunk_owners = owners[start : start + MINHASH_CHUNK_SIZE]
+            values = hashes[start : start + MINHASH_CHUNK_SIZE, None] * self.a + self.b
+            # the shingles of an example are consecutive
+            firsts = np.flatnonzero(
+                np.concatenate([[True], chunk_owners[1:] != chunk_owners[:-1]])
+            )
+            minimums = np.minimum.reduceat(values, firsts, axis=0)
+            rows = chunk_owners[firsts]
+            signatures[rows] = np.minimum(signatures[rows], minimums)
+        valid = np.zeros(len(examples), dtype=bool)
+        valid[owners] = True
+        return signatures, valid
+
+    def _band_keys(self, signatures):
+        keys = np.zeros((len(signatures), self.bands), dtype=np.uint64)
+        bands = signatures.reshape(len(signatures), self.bands, self.rows)
+        for j in range(self.rows):
+            keys = keys * np.uint64(FINGERPRINT_BASE) + bands[:, :, j]
+        return keys
+
+    def candidates(self, examples, threshold=0.0):
+        """
+        Returns the candidate pairs of the given examples (sequences of tokens) and
+        testset examples, as (example, testset name, testset example, estimated
+        Jaccard similarity), for the candidates with a similarity of at least threshold.
+        """
+        found = []
+        for n in self.sizes:
+            signatures, valid = self.signatures_of(examples, n)
+            keys = self._band_keys(signatures)
+            for d in np.flatnonzero(valid).tolist():
+                pairs = set()
+                for band, key in enumerate(keys[d].tolist()):
+                    pairs.update(self.tables[band].get((n, key), ()))
+                for t, i in sorted(pairs):
+                    jaccard = float(np.mean(signatures[d] == self.signatures[t][i]))
+                    if jaccard >= threshold:
+                        found.append((d, self.names[t], i, jaccard))
+        return found
+
+    def run(
+        self,
+        dataset,
+        threshold=0.0,
+        n_workers=cpu_count(),
+        chunk_size=STREAMING_CHUNK_SIZE,
+    ):
+        """
+        Streams the dataset (with or without random access) against the index in a
+        pool of workers, and returns the candidate pairs (see candidates()), with the
+        dataset index of each document, sorted.
+        """
+        random_access = hasattr(dataset, "__len__") and hasattr(dataset, "__getitem__")
+        context = _MinHashContext(dataset if random_access else None, self, threshold)
+        found = []
+        with Pool(n_workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for pairs in tqdm(
+                imap_bounded(
+                    pool,
+                    _minhash_chunk,
+                    _dataset_chunks(dataset, chunk_size),
+                    max_pending=2 * n_workers,
+                ),
+                desc="MinHash",
+            ):
+                found.extend(pairs)
+        found.sort()
+        return found
+
+
+_cached_token_hash = functools.lru_cache(maxsize=1 << 20)(token_hash)
+
+
+def _mix64(hashes):
+    """
+    splitmix64 finalizer (see OverlapyBloomFilter) of an array of fingerprints.
+    """
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+class _MinHashContext:
+    """
+    State shared by the workers of OverlapyMinHash.run().
+    """
+
+    def __init__(self, dataset, minhash, threshold):
+        self.dataset = dataset
+        self.minhash = minhash
+        self.threshold = threshold
+
+
+def _minhash_chunk(args):
+    idxs, examples = args
+    if examples is None:
+        examples = [_context.dataset[i] for i in idxs]
+    pairs = _context.minhash.candidates(examples, _context.threshold)
+    return [(idxs[d], name, i, jaccard) for d, name, i, jaccard in pairs]
+
+
+class OverlapySuffixArray:
+    """
+    Disk-backed suffix array over a pretraining dataset, encoded as token ids.
+
+    It allows counting and locating ngrams of any size by binary search, and finding
+    the longest substring an example has in common with the dataset, without having
+    to choose N beforehand.
+
+    The dataset is stored as a single array of token ids (tokens.bin), in which each
+    example is followed by a separator (id 0, the UNKNOWN id of the corpus vocabulary),
+    along with the start offset of each example (documents.bin) and the vocabulary
+    (vocabulary.json). Token ids are stored big-endian, so that comparing the raw
+    bytes of two sequences compares their ids. The suffix array (suffixes.bin) is built
+    out-of-core: the suffixes of shards of positions are sorted in a pool of workers
+    and the shards are then merged with a k-way merge, in blocks of array operations
+    over the suffixes' prefixes when numpy is available. Every file is memory-mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "vocabulary.json")) as fr:
+            self.vocabulary = OverlapyVocabulary(json.load(fr))
+        self.text = _map_file(os.path.join(path, "tokens.bin"))
+        self.documents = memoryview(
+            _map_file(os.path.join(path, "documents.bin"))
+        ).cast("Q")
+        self.suffixes = memoryview(_map_file(os.path.join(path, "suffixes.bin"))).cast(
+            "Q"
+        )
+
+    @classmethod
+    def build(
+        cls,
+        dataset,
+        path,
+        shard_size=SUFFIX_ARRAY_SHARD_SIZE,
+        n_workers=cpu_count(),
+    ):
+        """
+        Encodes the dataset (sequences of tokens) and builds its suffix array in the
+        directory path. An OverlapyTokenizedCorpus is used as is, with its vocabulary.
+        """
+        os.makedirs(path, exist_ok=True)
+        tokens_path = os.path.join(path, "tokens.bin")
+        tokenized = isinstance(dataset, OverlapyTokenizedCorpus)
+        vocabulary = dataset.vocabulary if tokenized else OverlapyVocabulary()
+        documents = array("Q")
+        examples = dataset
+        if hasattr(dataset, "__len__") and hasattr(dataset, "__getitem__"):
+            examples = (dataset[idx] for idx in range(len(dataset)))
+        with open(tokens_path, "wb") as fw:
+            n_tokens = 0
+            for example in examples:
+                documents.append(n_tokens)
+                if tokenized:
+                    ids = array("I", example)
+                else:
+                    ids = array("I", map(vocabulary.add, example))
+                ids.append(OverlapyVocabulary.UNKNOWN)
+                fw.write(_big_endian(ids))
+                n_tokens += len(ids)
+        with open(os.path.join(path, "documents.bin"), "wb") as fw:
+            documents.tofile(fw)
+        with open(os.path.join(path, "vocabulary.json"), "w") as fw:
+            json.dump(vocabulary.tokens[1:], fw)
+
+        shards = [
+            (tokens_path, start, min(start + shard_size, n_tokens))
+            for start in range(0, n_tokens, shard_size)
+        ]
+        with Pool(n_workers) as pool:
+            shard_paths = list(
+                tqdm(
+                    pool.imap(_sort_suffixes, shards),
+                    total=len(shards),
+                    desc="Sorting suffixes",
+                )
+            )
+
+        text = _map_file(tokens_path)
+        shards = [memoryview(_map_file(p)).cast("Q") for p in shard_paths]
+        with open(os.path.join(path, "suffixes.bin"), "wb") as fw:
+            if np is not None:
+                _merge_suffixes(text, shards, fw)
+            else:
+                merged = heapq.merge(
+                    *shards, key=lambda position: _SuffixKey(text, position)
+                )
+                while True:
+                    chunk = array("Q", islice(merged, 1 << 20))
+                    if not chunk:
+                        break
+                    chunk.tofile(fw)
+        del shards
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+        return cls(path)
+
+    def _encode(self, tokens):
+        """
+        Encodes tokens as big-endian ids, returning None if any token is unknown.
+        """
+        ids = self.vocabulary.encode(tokens)
+        if OverlapyVocabulary.UNKNOWN in ids:
+            return None
+        return _big_endian(ids)
+
+    def _range(self, pattern, lo=0, hi=None):
+        """
+        Returns the range of the suffix array whose suffixes start with the pattern
+        (big-endian ids), within [lo, hi).
+        """
+        text, suffixes, k = self.text, self.suffixes, len(pattern)
+        hi = len(suffixes) if hi is None else hi
+        first, last = lo, hi
+        while first < last:
+            mid = (first + last) // 2
+            position = 4 * suffixes[mid]
+            if text[position : position + k] < pattern:
+                first = mid + 1
+            else:
+                last = mid
+        lo, last = first, hi
+        while first < last:
+            mid = (first + last) // 2
+            position = 4 * suffixes[mid]
+            if text[position : position + k] <= pattern:
+                first = mid + 1
+            else:
+                last = mid
+        return lo, first
+
+    def _document(self, position):
+        """
+        Converts a position in the dataset into (example id, position within example).
+        """
+        i = bisect.bisect_right(self.documents, position) - 1
+        return i, position - self.documents[i]
+
+    def count(self, ngram):
+        """
+        Number of occurrences of an ngram (a sequence of tokens) in the dataset.
+        """
+        pattern = self._encode(ngram)
+        if not pattern:
+            return 0
+        lo, hi = self._range(pattern)
+        return hi - lo
+
+    def locate(self, ngram):
+        """
+        Occurrences of an ngram in the dataset, as a sorted list of
+        (example id, position within example).
+        """
+        pattern = self._encode(ngram)
+        if not pattern:
+            return []
+        lo, hi = self._range(pattern)
+        return sorted(self._document(self.suffixes[i]) for i in range(lo, hi))
+
+    def longest_common_substring(self, example):
+        """
+        Finds the longest substring of the example (a sequence of tokens) that occurs in
+        the dataset. Returns (length, position within example, occurrence), where the
+        occurrence is one (example id, position within example) in the dataset, or
+        (0, None, None) if no token of the example occurs in the dataset.
+        """
+        ids = self.vocabulary.encode(example)
+        encoded = _big_endian(ids)
+        best = (0, None, None)
+        for start in range(len(ids)):
+            if len(ids) - start <= best[0]:
+                break
+            lo, hi = 0, len(self.suffixes)
+            length = 0
+            while start + length < len(ids) and ids[start + length]:
+                pattern = encoded[4 * start : 4 * (start + length + 1)]
+                next_lo, next_hi = self._range(pattern, lo, hi)
+                if next_lo == next_hi:
+                    break
+                lo, hi = next_lo, next_hi
+                length += 1
+            if length > best[0]:
+                best = (length, start, self._document(self.suffixes[lo]))
+        return best
+
+    def query(self, testsets):
+        """
+        Counts the occurrences of the ngrams of testsets (of size N, see
+        OverlapyTestSet.compute_n()) in the dataset. The output follows the structure
+        of Overlapy.run(), with counts as values, and can be handed to
+        OverlapyTestSet.get_matches().
+        """
+        ngrams = set(
+            map(tuple, chain(*[list(testset.ngrams()) for testset in testsets]))
+        )
+        matches = {}
+        for ngram in ngrams:
+            count = self.count(ngram)
+            if count:
+                matches[ngram] = count
+        return matches
+
+
+class OverlapyTokenizedCorpus:
+    """
+    Pretraining dataset tokenized once and cached as token ids, so that it does not
+    have to be tokenized again on every run.
+
+    build() tokenizes the texts in a pool of workers and writes shards of examples,
+    each as a flat array of token ids (.tokens) and the offsets of its examples in
+    that array (.offsets), plus the vocabulary of the corpus (vocabulary.json).
+    Shards are memory-mapped when first read, and examples are returned as
+    memoryviews of token ids over them (no copy). Each mapped shard holds two file
+    descriptors, so at most max_open_shards are kept mapped, evicting the least
+    recently used. The corpus can be handed to Overlapy as a dataset.
+    """
+
+    def __init__(self, path, max_open_shards=64):
+        assert max_open_shards >= 1
+        self.path = path
+        self.max_open_shards = max_open_shards
+        with open(os.path.join(path, "manifest.json")) as fr:
+            manifest = json.load(fr)
+        with open(os.path.join(path, "vocabulary.json")) as fr:
+            self.vocabulary = OverlapyVocabulary(json.load(fr))
+        self.starts = [start for start, _, _ in manifest["shards"]]
+        self.n_examples = manifest["shards"][-1][1] if manifest["shards"] else 0
+        self.names = [name for _, _, name in manifest["shards"]]
+        self.shards = collections.OrderedDict()
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled: the corpus is mapped again from its path.
+        return self.path, self.max_open_shards
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _shard(self, shard):
+        """
+        Returns the tokens and offsets of a shard, mapping it if it is not yet.
+        """
+        arrays = self.shards.get(shard)
+        if arrays is not None:
+            self.shards.move_to_end(shard)
+            return arrays
+        if len(self.shards) >= self.max_open_shards:
+            # The maps are closed once the examples still viewing them are released.
+            self.shards.popitem(last=False)
+        name = os.path.join(self.path, self.names[shard])
+        arrays = self.shards[shard] = (
+            memoryview(_map_file(name + ".tokens")).cast("I"),
+            memoryview(_map_file(name + ".offsets")).cast("Q"),
+        )
+        return arrays
+
+    @classmethod
+    def build(
+        cls,
+        texts,
+        path,
+        tokenizer,
+        n_workers=cpu_count(),
+        chunk_size=CHECKPOINT_CHUNK_SIZE,
+    ):
+        """
+        Tokenizes the texts (with or without random access) with tokenizer, a picklable
+        function from a text to a sequence of tokens, and saves the corpus to the
+        directory path, one shard per chunk_size texts.
+        """
+        os.makedirs(path, exist_ok=True)
+        vocabulary = OverlapyVocabulary()
+        shards = []
+        random_access = hasattr(texts, "__len__") and hasattr(texts, "__getitem__")
+        context = _TokenizerContext(texts if random_access else None, tokenizer)
+        with Pool(n_workers, initializer=_init_worker, initargs=(context,)) as pool:
+            for idxs, tokens, local_ids, offsets in tqdm(
+                imap_bounded(
+                    pool,
+                    _tokenize_chunk,
+                    _dataset_chunks(texts, chunk_size),
+                    max_pending=2 * n_workers,
+                ),
+                desc="Tokenizing",
+            ):
+                # Workers number tokens in order of appearance within their chunk,
+                # which is translated here into the ids of the corpus vocabulary.
+                table = array("I", map(vocabulary.add, tokens))
+                if np is not None:
+                    ids = np.frombuffer(table, dtype=np.uint32)[
+                        np.frombuffer(local_ids, dtype=np.uint32)
+                    ]
+                else:
+                    ids = array("I", map(table.__getitem__, local_ids))
+                name = f"shard-{idxs.start:012d}"
+                with open(os.path.join(path, name + ".tokens"), "wb") as fw:
+                    fw.write(memoryview(ids).cast("B"))
+                with open(os.path.join(path, name + ".offsets"), "wb") as fw:
+                    offsets.tofile(fw)
+                shards.append([idxs.start, idxs.stop, name])
+
+        with open(os.path.join(path, "vocabulary.json"), "w") as fw:
+            json.dump(vocabulary.tokens[1:], fw)
+        with open(os.path.join(path, "manifest.json"), "w") as fw:
+            json.dump({"shards": sorted(shards)}, fw)
+        return cls(path)
+
+    def __len__(self):
+        return self.n_examples
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.n_examples:
+            raise IndexError(idx)
+        shard = bisect.bisect_right(self.starts, idx) - 1
+        tokens, offsets = self._shard(shard)
+        i = idx - self.starts[shard]
+        return tokens[offsets[i] : offsets[i + 1]]
+
+    def translation(self, vocabulary):
+        """
+        Returns a function translating examples of the corpus into ids of another
+        vocabulary (e.g. the testsets' one), as arrays of ids.
+        """
+        table = array(
+            "I",
+            (
+                vocabulary.ids.get(token, OverlapyVocabulary.UNKNOWN)
+                for token in self.vocabulary.tokens
+            ),
+        )
+        table[0] = OverlapyVocabulary.UNKNOWN
+        return _Translation(table)
+
+
+class _Translation:
+    """
+    Translates arrays of token ids through a lookup table (see
+    OverlapyTokenizedCorpus.translation()).
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __call__(self, ids):
+        if np is None:
+            return array("I", map(self.table.__getitem__, ids))
+        translated = array("I")
+        translated.frombytes(
+            np.frombuffer(self.table, dtype=np.uint32)[
+                np.frombuffer(ids, dtype=np.uint32)
+            ].tobytes()
+        )
+        return translated
+
+
+class _TokenizerContext:
+    """
+    State shared by every worker of OverlapyTokenizedCorpus.build().
+    """
+
+    def __init__(self, texts, tokenizer):
+        self.texts = texts
+        self.tokenizer = tokenizer
+
+
+def _tokenize_chunk(args):
+    """
+    Tokenizes a chunk of texts. Returns the distinct tokens, in order of appearance,
+    the tokens of the chunk as indexes into them, and the offsets of the examples.
+    """
+    idxs, texts = args
+    if texts is None:
+        texts = [_context.texts[idx] for idx in idxs]
+    local = {}
+    ids = array("I")
+    offsets = array("Q", [0])
+    for text in texts:
+        for token in _context.tokenizer(text):
+            token_id = local.get(token)
+            if token_id is None:
+                token_id = local[token] = len(local)
+            ids.append(token_id)
+        offsets.append(len(ids))
+    return idxs, list(local), ids, offsets
+
+
+class OverlapyPrefetchReader:
+    """
+    Streaming dataset of documents read concurrently from files or byte ranges of
+    files, so that reading overlaps with matching instead of stalling the workers.
+
+    sources are paths, or (path, offset, length) byte ranges. The documents are read
+    by an asyncio event loop in a background thread, at most concurrency at a time,
+    and decoded with decode, a function from the bytes read to a document (e.g. the
+    tokens of a text). At most read_ahead documents are read ahead of the consumer:
+    when it falls behind, reading pauses (backpressure). Documents are yielded in the
+    order of sources.
+
+    read, when given, is a coroutine function from a source to its bytes, for storage
+    with an asyncio client (e.g. an object store); otherwise, the files are read by a
+    pool of threads, which also decode them.
+
+    Overlapy streams the reader (see Overlapy's streaming) to its workers, which match
+    earlier batches while the following documents are being read.
+    """
+
+    def __init__(
+        self, sources, decode=bytes.decode, read=None, read_ahead=64, concurrency=16
+    ):
+        assert read_ahead >= 1 and concurrency >= 1
+        self.sources = sources
+        self.decode = decode
+        self.read = read
+        self.read_ahead = read_ahead
+        self.concurrency = concurrency
+
+    def __iter__(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        executor = ThreadPoolExecutor(self.concurrency)
+        reads = asyncio.Queue()
+        slots = asyncio.Semaphore(self.read_ahead)
+        asyncio.run_coroutine_threadsafe(self._produce(reads, slots, executor), loop)
+        try:
+            while True:
+                ok, document = asyncio.run_coroutine_threadsafe(
+                    self._next(reads, slots), loop
+                ).result()
+                if not ok:
+                    raise document
+                if document is _END:
+                    return
+                yield document
+        finally:
+            asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            executor.shutdown(cancel_futures=True)
+
+    async def _produce(self, reads, slots, executor):
+        """
+        Starts the reads in order, as slots are freed by the consumer.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        for source in self.sources:
+            await slots.acquire()
+            read = asyncio.ensure_future(self._read(source, semaphore, executor))
+            await reads.put(read)
+        await reads.put(None)
+
+    async def _read(self, source, semaphore, executor):
+        async with semaphore:
+            if self.read is None:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    executor, _read_source, source, self.decode
+                )
+            return self.decode(await self.read(source))
+
+    @staticmethod
+    async def _next(reads, slots):
+        read = await reads.get()
+        if read is None:
+            return True, _END
+        try:
+            return True, await read
+        except Exception as e:
+            return False, e
+        finally:
+            slots.release()
+
+
+_END = object()
+
+
+async def _cancel_tasks():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _read_source(source, decode):
+    """
+    Reads and decodes a file, or a (path, offset, length) byte range of a file.
+    """
+    if isinstance(source, tuple):
+        path, offset, length = source
+        with open(path, "rb") as fr:
+            fr.seek(offset)
+            return decode(fr.read(length))
+    with open(source, "rb") as fr:
+        return decode(fr.read())
+
+
+class OverlapyShardReader:
+    """
+    Streaming dataset over shards of a corpus: JSONL or plain-text files (one document
+    per line), either uncompressed, gzip (.gz) or zstd (.zst, which requires the
+    zstandard package) compressed.
+
+    The shards are streamed, never loaded whole, and decompressed and parsed in
+    parallel by n_workers threads, each reading ahead a bounded number of batches of
+    its shard (decompression releases the GIL). Documents are yielded in a
+    deterministic order, shard by shard, in the order of paths. The document on line
+    i (from 0) of shard s (its index in paths) has the stable ID (s, i): items() yields
+    (ID, document) pairs, and locate() maps the offset of a document in the stream,
+    which Overlapy's matches refer to, back to its ID.
+
+    field is the key of the text in the JSONL records, or a function from a record
+    to its text. The format is guessed from the file name (.jsonl or .json for
+    JSONL, anything else for plain text) unless given ("jsonl" or "text").
+    Documents are texts, or their tokens when tokenizer is given; the texts may
+    also be tokenized in parallel by OverlapyTokenizedCorpus.build().
+    """
+
+    def __init__(
+        self,
+        paths,
+        field="text",
+        tokenizer=None,
+        format=None,
+        n_workers=cpu_count(),
+        read_ahead=4,
+    ):
+        assert format in (None, "jsonl", "text")
+        assert n_workers >= 1 and read_ahead >= 1
+        self.paths = list(paths)
+        self.field = field
+        self.tokenizer = tokenizer
+        self.format = format
+        self.n_workers = n_workers
+        self.read_ahead = read_ahead
+        # stream offset of the first document of each shard read so far
+        self.shard_starts = []
+
+    def __iter__(self):
+        for _, document in self.items():
+            yield document
+
+    def items(self):
+        """
+        Yields the (shard, line) ID and the document of each line of the shards.
+        """
+        self.shard_starts = []
+        offset = 0
+        stop = threading.Event()
+        readers = collections.deque()
+        executor = ThreadPoolExecutor(self.n_workers)
+        next_shard = 0
+        try:
+            for shard in range(len(self.paths)):
+                # keep the next n_workers shards being read
+                while next_shard < min(shard + self.n_workers, len(self.paths)):
+                    batches = queue.Queue(self.read_ahead)
+                    executor.submit(self._read_shard, next_shard, batches, stop)
+                    readers.append(batches)
+                    next_shard += 1
+                batches = readers.popleft()
+                self.shard_starts.append(offset)
+                line = 0
+                while True:
+                    batch = batches.get()
+                    if batch is _END:
+                        break
+                    if isinstance(batch, Exception):
+                        raise batch
+                    for document in batch:
+                        yield (shard, line), document
+                        line += 1
+                offset += line
+        finally:
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+
+    def locate(self, offset):
+        """
+        Returns the (shard, line) ID of the document at offset in the stream, once
+        its shard has been read.
+        """
+        shard = bisect.bisect_right(self.shard_starts, offset) - 1
+        return shard, offset - self.shard_starts[shard]
+
+    @staticmethod
+    def _open(path):
+        """
+        Opens a shard as a text file, decompressing it on the fly.
+        """
+        path = os.fspath(path)
+        if path.endswith(".gz"):
+            return gzip.open(path, "rt", encoding="utf-8")
+        if path.endswith(".zst") or path.endswith(".zstd"):
+            if zstandard is None:
+                raise ImportError(f"Reading {path} requires the zstandard package")
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+            return io.TextIOWrapper(reader, encoding="utf-8")
+        return open(path, encoding="utf-8")
+
+    def _read_shard(self, shard, batches, stop):
+        """
+        Reads a shard into batches of documents, until it is done or stop is set.
+        """
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        path = os.fspath(self.paths[shard])
+        jsonl = self.format == "jsonl"
+        if self.format is None:
+            name = re.sub(r"\.(gz|zstd?)$", "", path)
+            jsonl = name.endswith(".jsonl") or name.endswith(".json")
+        try:
+            with self._open(path) as fr:
+                batch = []
+                for line in fr:
+                    if jsonl:
+                        record = json.loads(line) if line.strip() else {}
+                        if callable(self.field):
+                            text = self.field(record)
+                        else:
+                            text = record.get(self.field, "")
+                    else:
+                        text = line.rstrip("\n")
+                    if self.tokenizer is not None:
+                        text = self.tokenizer(text)
+                    batch.append(text)
+                    if len(batch) == READER_BATCH_SIZE:
+                        if not put(batch):
+                            return
+                        batch = []
+            if batch and not put(batch):
+                return
+            put(_END)
+        except Exception as e:
+            put(e)
+
+
+def _big_endian(ids):
+    """
+    Returns the bytes of an array of ids, in big-endian order.
+    """
+    if sys.byteorder == "little":
+        ids = array(ids.typecode, ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+
+def _map_file(path):
+    """
+    Memory-maps a file for reading (empty files cannot be mapped: b"" is returned).
+    """
+    with open(path, "rb") as fr:
+        if not os.fstat(fr.fileno()).st_size:
+            return b""
+        return mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _SuffixKey:
+    """
+    Sort key of a suffix of the dataset (see OverlapySuffixArray), comparing the
+    suffixes' bytes in chunks of growing size, so that comparisons cost only as
+    much as the length of the common prefix.
+    """
+
+    __slots__ = ("text", "start")
+
+    def __init__(self, text, position):
+        self.text = text
+        self.start = 4 * position
+
+    def __lt__(self, other):
+        text, a, b = self.text, self.start, other.start
+        step = 4 * SUFFIX_KEY_DEPTH
+        while True:
+            x, y = text[a : a + step], text[b : b + step]
+            if x != y:
+                return x < y
+            if len(x) < step:
+                return False
+            a, b, step = a + step, b + step, 2 * step
+
+
+def _sort_suffixes(args):
+    """
+    Sorts the suffixes starting in a shard of positions of the dataset and saves them.
+    Suffixes are first sorted by their first SUFFIX_KEY_DEPTH tokens, and only the ties
+    are then sorted by comparing whole suffixes. Separators do not start suffixes.
+    """
+    tokens_path, start, stop = args
+    text = _map_file(tokens_path)
+    depth = 4 * SUFFIX_KEY_DEPTH
+    separator = bytes(4)
+    positions = [p for p in range(start, stop) if text[4 * p : 4 * p + 4] != separator]
+    positions.sort(key=lambda p: text[4 * p : 4 * p + depth])
+
+    suffixes = array("Q")
+    for prefix, group in groupby(positions, key=lambda p: text[4 * p : 4 * p + depth]):
+        group = list(group)
+        if len(group) > 1 and len(prefix) == depth:
+            group.sort(key=lambda p: _SuffixKey(text, p))
+        suffixes.extend(group)
+
+    path = f"{tokens_path}.{start:012d}.suffixes"
+    with open(path, "wb") as fw:
+        suffixes.tofile(fw)
+    return path
+
+
+def _suffix_keys(data, positions):
+    """
+    Returns the first SUFFIX_KEY_DEPTH tokens of the suffixes at the given positions
+    of the dataset (data, as uint8), as fixed-size bytes padded with zeros.
+    """
+    depth = 4 * SUFFIX_KEY_DEPTH
+    offsets = 4 * positions.astype(np.int64)[:, None] + np.arange(depth)
+    keys = data[np.minimum(offsets, len(data) - 1)] * (offsets < len(data))
+    return np.ascontiguousarray(keys, dtype=np.uint8).view(f"S{depth}").ravel()
+
+
+def _merge_suffixes(text, shards, fw, block_size=SUFFIX_MERGE_BLOCK_SIZE):
+    """
+    Merges sorted shards of suffixes (positions of the dataset text) into fw.
+
+    Each round takes the next block of every shard, and emits the suffixes whose
+    prefix key (see _suffix_keys()) is below the smallest last key of the blocks
+    which do not end their shard: no suffix left behind can precede them. They are
+    sorted by key with numpy, and only suffixes with equal keys are compared whole.
+    When no suffix is below that bound, the suffixes with the bound as key, which
+    may span several blocks, are merged by comparing them whole.
+    """
+    data = np.frombuffer(text, dtype=np.uint8)
+    shards = [np.frombuffer(shard, dtype=np.uint64) for shard in shards]
+    cursors = [0] * len(shards)
+    block = max(block_size // max(len(shards), 1), 1)
+    while True:
+        live = [i for i, shard in enumerate(shards) if cursors[i] < len(shard)]
+        if not live:
+            break
+        blocks = {i: shards[i][cursors[i] : cursors[i] + block] for i in live}
+        keys = {i: _suffix_keys(data, blocks[i]) for i in live}
+        ends = [keys[i][-1] for i in live if cursors[i] + block < len(shards[i])]
+        bound = min(ends) if ends else None
+
+        positions, position_keys = [], []
+        for i in live:
+            n = len(keys[i])
+            if bound is not None:
+                n = int(np.searchsorted(keys[i], bound))
+            positions.append(blocks[i][:n])
+            position_keys.append(keys[i][:n])
+            cursors[i] += n
+        positions = np.concatenate(positions)
+        if not len(positions):
+            ties = []
+            for i in live:
+                stop = cursors[i]
+                while stop < len(shards[i]):
+                    chunk = shards[i][stop : stop + block]
+                    n = int(np.searchsorted(_suffix_keys(data, chunk), bound, "right"))
+                    stop += n
+                    if n < len(chunk):
+                        break
+                ties.extend(shards[i][cursors[i] : stop].tolist())
+                cursors[i] = stop
+            ties.sort(key=lambda p: _SuffixKey(text, p))
+            array("Q", ties).tofile(fw)
+            continue
+
+        position_keys = np.concatenate(position_keys)
+        order = np.argsort(position_keys, kind="stable")
+        positions, position_keys = positions[order], position_keys[order]
+        # runs of equal keys, as [start, stop) ranges
+        same = np.concatenate(
+            ([False], position_keys[1:] == position_keys[:-1], [False])
+        )
+        changes = np.flatnonzero(same[1:] != same[:-1])
+        for start, stop in zip(changes[::2].tolist(), changes[1::2].tolist()):
+            run = sorted(
+                positions[start : stop + 1].tolist(), key=lambda p: _SuffixKey(text, p)
+            )
+            positions[start : stop + 1] = run
+        positions.astype(np.uint64).tofile(fw)
+
+
+def imap_bounded(
+    pool, func, iterable, max_pending, stats=None, timeout=None, on_timeout=None
+):
+    """
+    Like Pool.imap_unordered, but the iterable is consumed lazily: no more than
+    max_pending tasks are submitted and not yet yielded at any time.
+    Pool.imap_unordered would exhaust the iterable upfront, which defeats streaming.
+    When given, the stats dict is kept up to date with the number of tasks pending
+    (submitted and not yet yielded) and ready (finished and not yet yielded), and
+    on_timeout() is called every timeout seconds spent waiting for a result.
+    """
+    results = queue.Queue()
+    pending = 0
+
+    def wait():
+        while True:
+            try:
+                ok, result = results.get(timeout=timeout)
+                break
+            except queue.Empty:
+                if stats is not None:
+                    stats["pending"] = pending
+                    stats["ready"] = 0
+                on_timeout()
+        if not ok:
+            raise result
+        if stats is not None:
+            stats["pending"] = pending - 1
+            stats["ready"] = results.qsize()
+        return result
+
+    for task in iterable:
+        pool.apply_async(
+            func,
+            (task,),
+            callback=lambda result: results.put((True, result)),
+            error_callback=lambda error: results.put((False, error)),
+        )
+        pending += 1
+        if pending >= max_pending:
+            yield wait()
+            pending -= 1
+    for _ in range(pending):
+        yield wait()
 
 
 def list_split(lst, sections):
@@ -185,3 +3724,211 @@ def list_split(lst, sections):
     return [
         lst[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(sections)
     ]
+
+
+def main(argv=None):
+    """
+    Command line entry point: runs the pipeline described by a JSON config file
+    (see run_pipeline()).
+    """
+    parser = argparse.ArgumentParser(
+        prog="overlapy", description="Computes the overlap of testsets and a corpus."
+    )
+    parser.add_argument("config", help="JSON config file (see run_pipeline())")
+    parser.add_argument("-o", "--output", help="output directory (overrides config)")
+    parser.add_argument("--force", action="store_true", help="ignore cached artifacts")
+    args = parser.parse_args(argv)
+    with open(args.config) as fr:
+        config = json.load(fr)
+    run_pipeline(config, output=args.output, force=args.force)
+
+
+def run_pipeline(config, output=None, force=False):
+    """
+    Runs the pipeline described by a config, writing its artifacts and results to
+    an output directory (config["output"] by default), and returns the directory
+    of the results. For example:
+
+        {
+            "testsets": [
+                {"name": "squad", "paths": ["squad.jsonl"], "field": "question"}
+            ],
+            "corpus": ["corpus/*.jsonl.zst"],
+            "field": "text",
+            "tokenizer": "overlapy",
+            "engine": "aho-corasick",
+            "results": "documents",
+            "n_workers": {"tokenize": 8, "scan": 16},
+            "output": "contamination"
+        }
+
+    The stages are: tokenize, which caches the corpus shards as an
+    OverlapyTokenizedCorpus; index, which builds the OverlapyIndex of the testsets;
+    scan, a checkpointed (thus resumable) run of Overlapy; and merge, which writes
+    matches.jsonl (the documents, as [shard, line], of each ngram) and
+    contaminated.json (the matches of the examples of each testset). Each artifact
+    is named after a hash of its inputs (the corpus shards are identified by path,
+    size and modification time), and stages whose artifact exists are skipped,
+    unless force is set.
+
+    testsets are read like the corpus (see OverlapyShardReader) and may set min_n,
+    max_n and percentile (see OverlapyTestSet). tokenizer is "overlapy"
+    (OverlapyTokenizer), "whitespace", or the "module:function" of a picklable
+    function. n_workers is a number, or a number per stage. Other keys are optional
+    arguments of Overlapy: engine, results, chunk_size, batch_size, prefilter and
+    dedup_cache.
+    """
+    output = output or config.get("output", "overlapy-output")
+    os.makedirs(output, exist_ok=True)
+
+    def n_workers(stage):
+        value = config.get("n_workers", cpu_count())
+        if isinstance(value, dict):
+            value = value.get(stage, cpu_count())
+        return min(value, cpu_count())
+
+    def artifact(name, inputs):
+        key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+        path = os.path.join(output, f"{name}-{key[:16]}")
+        cached = os.path.exists(path) and not force
+        print(f"{name}: {'reusing' if cached else 'building'} {path}", file=sys.stderr)
+        return path, cached
+
+    tokenizer_name = config.get("tokenizer", "overlapy")
+    tokenizer = _load_tokenizer(tokenizer_name)
+    field = config.get("field", "text")
+    shards = sorted(chain(*[glob.glob(pattern) for pattern in config["corpus"]]))
+    if not shards:
+        raise ValueError("The corpus matches no files")
+
+    # tokenize
+    inputs = {
+        "shards": [
+            (path, os.path.getsize(path), os.stat(path).st_mtime_ns) for path in shards
+        ],
+        "field": field,
+        "tokenizer": tokenizer_name,
+    }
+    corpus_path, cached = artifact("corpus", inputs)
+    if not cached:
+        reader = OverlapyShardReader(shards, field, n_workers=n_workers("tokenize"))
+        OverlapyTokenizedCorpus.build(
+            reader,
+            corpus_path + ".tmp",
+            tokenizer,
+            n_workers=n_workers("tokenize"),
+            chunk_size=config.get("tokenize_chunk_size", CHECKPOINT_CHUNK_SIZE),
+        )
+        with open(os.path.join(corpus_path + ".tmp", "shards.json"), "w") as fw:
+            json.dump({"paths": shards, "starts": reader.shard_starts}, fw)
+        if os.path.exists(corpus_path):
+            shutil.rmtree(corpus_path)
+        os.replace(corpus_path + ".tmp", corpus_path)
+    corpus = OverlapyTokenizedCorpus(corpus_path)
+    with open(os.path.join(corpus_path, "shards.json")) as fr:
+        shard_starts = json.load(fr)["starts"]
+
+    # index
+    testsets = []
+    for spec in config["testsets"]:
+        reader = OverlapyShardReader(
+            spec["paths"], spec.get("field", "text"), tokenizer, n_workers=1
+        )
+        testsets.append(
+            OverlapyTestSet(
+                spec["name"],
+                min_n=spec.get("min_n", 8),
+                max_n=spec.get("max_n", 13),
+                percentile=spec.get("percentile", 5),
+                examples=list(reader),
+            )
+        )
+    index_path, cached = artifact(
+        "index",
+        {
+            "testsets": OverlapyIndex.testsets_hash(testsets),
+            "tokenizer": tokenizer_name,
+            "version": OverlapyIndex.VERSION,
+        },
+    )
+    if not cached:
+        OverlapyIndex.build(testsets).save(index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+    index = OverlapyIndex.load(index_path, testsets)
+
+    # scan
+    options = {
+        key: config[key]
+        for key in (
+            "engine",
+            "results",
+            "chunk_size",
+            "batch_size",
+            "prefilter",
+            "dedup_cache",
+        )
+        if key in config
+    }
+    options.setdefault("results", "documents")
+    inputs = {"corpus": corpus_path, "index": index.content_hash, **options}
+    scan_path, _ = artifact("scan", inputs)
+    results_path, cached = artifact("results", inputs)
+    if cached:
+        return results_path
+    if force and os.path.exists(scan_path):
+        shutil.rmtree(scan_path)
+    overlapy = Overlapy(
+        testsets, corpus, n_workers=n_workers("scan"), index=index, **options
+    )
+    overlapy.run(checkpoint_dir=scan_path, merge=False)
+
+    # merge, streamed from the shards: only the matched ngrams are kept in memory
+    matched = {}
+    os.makedirs(results_path + ".tmp", exist_ok=True)
+    with open(os.path.join(results_path + ".tmp", "matches.jsonl"), "w") as fw:
+        for ngram, value in overlapy.merge_checkpoint(scan_path):
+            matched[ngram] = None
+            record = {"ngram": list(ngram)}
+            if options["results"] == "counts":
+                record["count"] = value
+            else:
+                record["documents"] = [
+                    [shards[shard], idx - shard_starts[shard]]
+                    for shard, idx in (
+                        (bisect.bisect_right(shard_starts, idx) - 1, idx)
+                        for idx in value
+                    )
+                ]
+            fw.write(json.dumps(record) + "\n")
+    with open(os.path.join(results_path + ".tmp", "contaminated.json"), "w") as fw:
+        json.dump(
+            {
+                testset.name: [
+                    {"example": i, "ngram": list(ngram), "position": position}
+                    for i, ngram, position in testset.get_matches(matched)
+                ]
+                for testset in testsets
+            },
+            fw,
+        )
+    if os.path.exists(results_path):
+        shutil.rmtree(results_path)
+    os.replace(results_path + ".tmp", results_path)
+    print(f"results: {results_path}", file=sys.stderr)
+    return results_path
+
+
+def _load_tokenizer(name):
+    """
+    Returns the tokenizer named in a config (see main()).
+    """
+    if name == "overlapy":
+        return OverlapyTokenizer()
+    if name == "whitespace":
+        return str.split
+    module, _, function = name.partition(":")
+    return getattr(importlib.import_module(module), function)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,7 +25,9 @@ setup(
         "Programming Language :: Python :: 3 :: Only",
     ],
     install_requires=["stringology"],
+    extras_require={"numpy": ["numpy"], "zstd": ["zstandard"], "parquet": ["pyarrow"]},
     keywords="text tool",
     package_dir={"": "."},
     py_modules=["overlapy"],
+    entry_points={"console_scripts": ["overlapy=overlapy:main"]},
 )
@@ -1,5 +1,32 @@
+import asyncio
+import csv
+import gzip
+import json
+import threading
+import time
+from array import array
+from itertools import chain
+from multiprocessing.connection import Client
+
 import pytest
-from overlapy import OverlapyNgramMatcher, OverlapyTestSet
+from overlapy import (
+    Overlapy,
+    OverlapyCoordinator,
+    OverlapyCorpusSummary,
+    OverlapyHashMatcher,
+    OverlapyIndex,
+    OverlapyNgramMatcher,
+    OverlapyPrefetchReader,
+    OverlapyShardReader,
+    OverlapySuffixArray,
+    OverlapyTestSet,
+    OverlapyTokenizedCorpus,
+    OverlapyTokenizer,
+    OverlapyVocabulary,
+    fingerprint,
+    main,
+    run_worker,
+)
 
 
 @pytest.fixture
@@ -68,3 +95,933 @@ def test_match(examples1, ts1):
     match = OverlapyNgramMatcher(ts1.ngrams())
     matched = match(train_examples)
     assert matched == {"123": [0, 0, 1, 1, 2, 2], "234": [0, 0, 1, 1], "345": [0, 0]}
+
+
+def test_matcher_agrees_with_stringology(examples1, ts1):
+    from stringology.ac import AhoCorasick
+
+    ngrams = set(ts1.ngrams())
+    match = OverlapyNgramMatcher(ngrams)
+    ac = AhoCorasick(ngrams)
+    for example in examples1 + ["5432112345", "1231234"]:
+        assert list(match.scan(example)) == list(ac(example))
+
+
+@pytest.mark.parametrize("symbol", [int, str])
+def test_matcher_dense_states(symbol):
+    from stringology.ac import AhoCorasick
+
+    # State (1,) has many edges, (2,) has a single one and (3,) a few.
+    ngrams = {(1, k) for k in range(10, 30)} | {(2, 5, 6), (3, 4), (3, 7), (7, 1)}
+    ngrams = {tuple(map(symbol, ngram)) for ngram in ngrams}
+    match = OverlapyNgramMatcher(ngrams)
+    assert len(match.dense) == 2
+    ac = AhoCorasick(ngrams)
+    example = [1, 12, 2, 5, 6, 3, 7, 1, 29, 3, 4, 8, 2, 5, 1, 1, 30, 3, 9]
+    example = list(map(symbol, example))
+    assert list(match.scan(example)) == list(ac(example))
+
+
+def test_matcher_pickles(examples1, ts1):
+    import pickle
+
+    original = OverlapyNgramMatcher(ts1.ngrams())
+    match = pickle.loads(pickle.dumps(original))
+    assert match.edges == original.edges
+    matched = match([example + example for example in examples1])
+    assert matched == {"123": [0, 0, 1, 1, 2, 2], "234": [0, 0, 1, 1], "345": [0, 0]}
+
+
+def test_matcher_tables(examples1, ts1):
+    vocabulary = OverlapyVocabulary.from_testsets([ts1])
+    ngrams = {tuple(vocabulary.encode(ngram)) for ngram in ts1.ngrams()}
+    match = OverlapyNgramMatcher(ngrams)
+    assert match.alphabet is None
+    tables = {name: memoryview(values) for name, values in match.tables().items()}
+    loaded = OverlapyNgramMatcher.from_tables(tables)
+    examples = [vocabulary.encode(example + example) for example in examples1]
+    assert loaded(examples) == match(examples)
+    assert {vocabulary.decode(ngram) for ngram in loaded(examples)} == {
+        ("1", "2", "3"),
+        ("2", "3", "4"),
+        ("3", "4", "5"),
+    }
+
+
+@pytest.fixture
+def synthetic():
+    pretraining_dataset = [
+        "A B A C D E F G",
+        "A C F J K H E",
+        "V L N M Q",
+        "A B A C Ç T Z V E",
+        "L M N O P",
+    ]
+    testset_examples = [
+        "B A B A C O Q W R",
+        "O P Q F J K H",
+        "W E R E",
+        "I E T Z V E L",
+        "K E K W",
+    ]
+    testset = OverlapyTestSet(
+        "test", min_n=1, examples=[s.split() for s in testset_examples]
+    )
+    return testset, [s.split() for s in pretraining_dataset]
+
+
+def test_run(synthetic):
+    testset, dataset = synthetic
+    matches = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    assert dict(matches) == {
+        ("A", "B", "A", "C"): [0, 3],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+    assert [i for i, _, _ in testset.get_matches(matches)] == [0, 1, 3]
+
+
+def test_run_dynamic_scheduling(synthetic):
+    testset, dataset = synthetic
+    overlapy = Overlapy(testsets=[testset], dataset=dataset, n_workers=1, chunk_size=2)
+    assert [list(idxs) for idxs, _, _ in overlapy._tasks(2)] == [[0, 1], [2, 3], [4]]
+    matches = overlapy.run()
+    assert {ngram: sorted(idxs) for ngram, idxs in matches.items()} == {
+        ("A", "B", "A", "C"): [0, 3],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+    (stats,) = overlapy.worker_stats.values()
+    assert stats["tasks"] == 3 and stats["examples"] == 5
+    assert 0 <= stats["utilization"] <= 1
+
+
+def test_run_streaming(synthetic):
+    testset, dataset = synthetic
+    overlapy = Overlapy(
+        testsets=[testset],
+        dataset=(example for example in dataset),
+        n_workers=1,
+        chunk_size=2,
+    )
+    assert overlapy.streaming
+    matches = overlapy.run()
+    assert {ngram: sorted(idxs) for ngram, idxs in matches.items()} == {
+        ("A", "B", "A", "C"): [0, 3],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+
+
+def test_run_metrics(synthetic, tmp_path):
+    testset, dataset = synthetic
+    records = []
+    overlapy = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=1,
+        chunk_size=2,
+        metrics=records.append,
+        metrics_interval=0,
+        progress=False,
+    )
+    overlapy.run()
+    events = [record["event"] for record in records]
+    assert events[-1] == "done" and set(events[:-1]) == {"progress"}
+    # progress includes the work units still running
+    examples = [record["examples"] for record in records]
+    assert examples == sorted(examples) and examples[-1] == 5
+    last = records[-1]
+    assert last == overlapy.last_metrics
+    assert last["tokens"] == sum(map(len, dataset)) and last["matches"] == 4
+    assert set(last["phases"]) == {"ngrams", "build", "scan", "merge"}
+    (worker,) = last["workers"].values()
+    assert worker["tasks"] == 3 and worker["examples"] == 5
+
+    with open(tmp_path / "metrics.jsonl", "w") as fw:
+        Overlapy(testsets=[testset], dataset=dataset, n_workers=1, metrics=fw).run()
+    with open(tmp_path / "metrics.jsonl") as fr:
+        (record,) = map(json.loads, fr)
+    assert record["event"] == "done" and record["matches"] == 4
+
+
+class SlowDataset:
+    def __init__(self, examples, delay):
+        self.examples = examples
+        self.delay = delay
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, idx):
+        time.sleep(self.delay)
+        return self.examples[idx]
+
+
+def test_run_metrics_interval(synthetic):
+    testset, dataset = synthetic
+    records = []
+    Overlapy(
+        testsets=[testset],
+        dataset=SlowDataset(dataset * 4, 0.02),
+        n_workers=1,
+        batch_size=1,
+        metrics=records.append,
+        metrics_interval=0.05,
+        progress=False,
+    ).run()
+    # a single work unit: progress is reported while it runs, from the workers' counters
+    progress = [record for record in records if record["event"] == "progress"]
+    assert progress and records[-1]["event"] == "done"
+    assert any(0 < record["examples"] < 20 for record in progress)
+    assert all(record["workers"] for record in progress)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1])
+def test_run_results(synthetic, chunk_size):
+    from array import array
+
+    testset, dataset = synthetic
+    dataset = dataset + [["A", "B", "A", "C", "A", "B", "A", "C"]]
+
+    def run(results):
+        return Overlapy(
+            testsets=[testset],
+            dataset=dataset,
+            n_workers=1,
+            chunk_size=chunk_size,
+            results=results,
+        ).run()
+
+    assert sorted(run("occurrences")[("A", "B", "A", "C")]) == [0, 3, 5, 5]
+    assert run("documents")[("A", "B", "A", "C")] == array("I", [0, 3, 5])
+    assert dict(run("counts")) == {
+        ("A", "B", "A", "C"): 4,
+        ("F", "J", "K", "H"): 1,
+        ("T", "Z", "V", "E"): 1,
+    }
+
+
+def test_vocabulary(examples1):
+    vocabulary = OverlapyVocabulary(["a", "b", "a"])
+    assert len(vocabulary) == 3
+    assert list(vocabulary.encode(["b", "z", "a"])) == [
+        2,
+        OverlapyVocabulary.UNKNOWN,
+        1,
+    ]
+    assert vocabulary.decode([1, 2]) == ("a", "b")
+
+
+@pytest.mark.parametrize("results", ["occurrences", "documents", "counts"])
+def test_run_vocabulary(synthetic, results):
+    testset, dataset = synthetic
+    expected = Overlapy(
+        testsets=[testset], dataset=dataset, n_workers=1, results=results
+    ).run()
+    matches = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=1,
+        results=results,
+        vocabulary=True,
+    ).run()
+    assert type(matches) is type(expected)
+    assert dict(matches) == dict(expected)
+
+
+def test_hash_matcher():
+    ngrams = {(1, 2, 3), (2, 3, 4), (3, 4, 5), (4, 5), (5, 1)}
+    examples = [[1, 2, 3, 4, 5, 1, 2, 3], [0, 4, 5, 0], [3, 2, 1]]
+    expected = OverlapyNgramMatcher(ngrams)(examples)
+    assert OverlapyHashMatcher(ngrams)(examples) == expected
+    assert expected[(1, 2, 3)] == [0, 0]
+
+
+def test_hash_matcher_collisions():
+    match = OverlapyHashMatcher({(1, 2), (3, 4)})
+    # Force every fingerprint of size 2 to collide.
+    table = match.tables[2]
+    table.clear()
+    for window in [(1, 2), (2, 3), (3, 4), (4, 1)]:
+        table[fingerprint(window)] = [(1, 2), (3, 4)]
+    assert dict(match([[1, 2, 3, 4, 1]])) == {(1, 2): [0], (3, 4): [0]}
+
+
+def test_run_rolling_hash(synthetic):
+    testset, dataset = synthetic
+    other = OverlapyTestSet(
+        "other", min_n=2, max_n=2, examples=[["Q", "W"], ["N", "M"]]
+    )
+    expected = Overlapy(testsets=[testset, other], dataset=dataset, n_workers=1).run()
+    overlapy = Overlapy(
+        testsets=[testset, other], dataset=dataset, n_workers=1, engine="rolling-hash"
+    )
+    assert overlapy.vocabulary is not None
+    assert overlapy.run() == expected
+    assert expected[("N", "M")] == [2]
+
+
+def test_numpy_matcher():
+    pytest.importorskip("numpy")
+    from overlapy import OverlapyNumpyMatcher
+
+    ngrams = {(1, 2, 3), (2, 3, 4), (3, 4, 5), (4, 5), (5, 1)}
+    examples = [[1, 2, 3, 4, 5, 1, 2, 3], [], [4], [5, 4, 5, 0], [1, 2], [3, 2, 1]]
+    assert OverlapyNumpyMatcher(ngrams)(examples) == OverlapyNgramMatcher(ngrams)(
+        examples
+    )
+
+
+def test_numpy_matcher_collisions():
+    np = pytest.importorskip("numpy")
+    from overlapy import OverlapyNumpyMatcher
+
+    match = OverlapyNumpyMatcher({(1, 2), (3, 4)})
+    # Force both ngrams to share the fingerprint of (1, 2).
+    h = fingerprint((1, 2))
+    match.tables[2] = (
+        np.array([h, h], dtype=np.uint64),
+        np.array([[3, 4], [1, 2]], dtype=np.uint64),
+    )
+    assert dict(match([[3, 4, 1, 2], [1, 2]])) == {(1, 2): [0, 1]}
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 100])
+def test_run_numpy(synthetic, batch_size):
+    pytest.importorskip("numpy")
+    testset, dataset = synthetic
+    expected = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    matches = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=1,
+        engine="numpy",
+        batch_size=batch_size,
+    ).run()
+    assert matches == expected
+
+
+def test_bloom_filter():
+    from overlapy import OverlapyBloomFilter
+
+    ngrams = {(1, 2, 3), (4, 5)}
+    bloom = OverlapyBloomFilter(ngrams, fp_rate=0.001)
+    assert fingerprint((1, 2, 3)) in bloom and fingerprint((4, 5)) in bloom
+    assert bloom.sizes == [2, 3]
+    examples = [[9, 1, 2, 3], [9, 9, 9], [4, 5], [], [5, 4, 3, 2, 1]]
+    assert [bloom.may_match(example) for example in examples] == [
+        True,
+        False,
+        True,
+        False,
+        False,
+    ]
+    assert bloom.candidates(examples) == [0, 2]
+
+
+def test_run_prefilter(synthetic):
+    testset, dataset = synthetic
+    expected = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    overlapy = Overlapy(
+        testsets=[testset], dataset=dataset, n_workers=1, prefilter=0.001
+    )
+    assert overlapy.run() == expected
+    assert overlapy.prefilter_stats["examples"] == 5
+    assert overlapy.prefilter_stats["rejected"] == 2
+    assert overlapy.prefilter_stats["size"] > 0
+
+
+@pytest.mark.parametrize("engine", ["aho-corasick", "rolling-hash", "numpy"])
+def test_run_stop_after(synthetic, engine):
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+    testset, dataset = synthetic
+    overlapy = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=1,
+        engine=engine,
+        batch_size=1,
+        stop_after=1,
+    )
+    # ("A", "B", "A", "C") is no longer tracked once seen in example 0
+    assert dict(overlapy.run()) == {
+        ("A", "B", "A", "C"): [0],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+    assert overlapy.contaminated == {"test": [0, 1, 3]}
+
+    overlapy = Overlapy(
+        testsets=[testset], dataset=dataset, n_workers=1, batch_size=1, stop_after=2
+    )
+    overlapy.run()
+    assert overlapy.contaminated == {"test": [0]}
+
+
+def test_run_stop_after_str(ts1):
+    # The matcher outputs ngrams of str examples as str.
+    overlapy = Overlapy(
+        testsets=[ts1], dataset=["51234", "999", "345"], n_workers=1, stop_after=1
+    )
+    overlapy.run()
+    assert overlapy.contaminated == {"ts1": [0, 1, 2]}
+
+
+def test_run_stop_after_checkpoint(synthetic, tmp_path):
+    testset, dataset = synthetic
+
+    def overlapy(results="occurrences"):
+        return Overlapy(
+            testsets=[testset],
+            dataset=dataset,
+            n_workers=1,
+            chunk_size=2,
+            results=results,
+            stop_after=1,
+        )
+
+    expected = overlapy()
+    matches = expected.run()
+    assert expected.contaminated == {"test": [0, 1, 3]}
+
+    overlapy().run(checkpoint_dir=tmp_path)
+    header, *shards = (tmp_path / "manifest.jsonl").read_text().splitlines()
+    (tmp_path / json.loads(shards[-1])[2]).unlink()
+    (tmp_path / "manifest.jsonl").write_text("\n".join([header, *shards[:-1]]) + "\n")
+    resumed = overlapy()
+    assert resumed.run(checkpoint_dir=tmp_path) == matches
+    assert resumed.contaminated == expected.contaminated
+
+    # Nothing left to scan: contaminated comes from the shards alone.
+    resumed = overlapy()
+    assert resumed.run(checkpoint_dir=tmp_path) == matches
+    assert resumed.contaminated == expected.contaminated
+
+    with pytest.raises(ValueError):
+        overlapy("documents").run(checkpoint_dir=tmp_path / "documents")
+
+
+def test_matcher_discard():
+    ngrams = {(1, 2, 3), (2, 3, 4), (3, 4), (9,)}
+    examples = [[1, 2, 3, 4, 9], [3, 4]]
+    matcher_classes = [OverlapyNgramMatcher, OverlapyHashMatcher]
+    try:
+        import numpy  # noqa: F401
+        from overlapy import OverlapyNumpyMatcher
+
+        matcher_classes.append(OverlapyNumpyMatcher)
+    except ImportError:
+        pass
+    for matcher_class in matcher_classes:
+        matcher = matcher_class(ngrams)
+        matcher.discard([(2, 3, 4), (9,), (5, 5)])
+        assert dict(matcher(examples)) == {(1, 2, 3): [0], (3, 4): [0, 1]}
+        matcher.discard([(1, 2, 3), (3, 4)])
+        assert dict(matcher(examples)) == {}
+
+
+def test_matcher_discard_cost():
+    # Only the pattern flags are written by a prune, the tables stay read-only.
+    ngrams = {(i, i + 1, i + 2) for i in range(1000)}
+    tables = OverlapyNgramMatcher(ngrams).tables()
+    matcher = OverlapyNgramMatcher.from_tables(
+        {name: memoryview(values).toreadonly() for name, values in tables.items()}
+    )
+    matcher.discard([(5, 6, 7), (6, 7)])
+    assert dict(matcher([[5, 6, 7, 8]])) == {(6, 7, 8): [0]}
+    assert matcher.output == tables["output"]
+
+
+def test_dedup_cache_key():
+    from overlapy import _DedupCache
+
+    assert _DedupCache.key(["a", "b"]) == _DedupCache.key(["a", "b"])
+    assert _DedupCache.key(["a", "b"]) != _DedupCache.key(["ab"])
+    assert max(_DedupCache.key([i]) for i in range(100)).bit_length() > 64
+    # Keys sharing their slot and their low 64 bits are still told apart.
+    cache = _DedupCache(3)
+    high = 3 << 64
+    cache._set_no_matches(high + 6)
+    assert cache._has_no_matches(high + 6)
+    assert not cache._has_no_matches(2 * high + 6)
+
+
+@pytest.mark.parametrize("vocabulary", [False, True])
+def test_run_dedup_cache(synthetic, vocabulary):
+    testset, dataset = synthetic
+    dataset = dataset * 3
+    expected = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    overlapy = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=1,
+        batch_size=2,
+        vocabulary=vocabulary,
+        dedup_cache=8,
+    )
+    assert overlapy.run() == expected
+    assert overlapy.dedup_stats["lookups"] == 15
+    assert overlapy.dedup_stats["hits"] == 10
+
+
+def test_index(synthetic, tmp_path):
+    testset, dataset = synthetic
+    other = OverlapyTestSet(
+        "other", min_n=2, max_n=2, examples=[["Q", "W"], ["N", "M"]]
+    )
+    index = OverlapyIndex.build([testset, other])
+    assert index.sizes == [2, 4]
+    assert set(map(index.vocabulary.decode, index.ngrams())) == set(
+        map(tuple, chain(testset.ngrams(), other.ngrams()))
+    )
+    index.save(tmp_path / "index")
+    loaded = OverlapyIndex.load(tmp_path / "index", testsets=[testset, other])
+    assert list(loaded.ngrams()) == list(index.ngrams())
+    assert loaded.provenance(["A", "B", "A", "C"]) == [("test", 0, 1)]
+    assert loaded.provenance(["Q", "W"]) == [("other", 0, 0)]
+    assert loaded.provenance(["W", "Q"]) == []
+    # The automaton is mapped from the file, not rebuilt.
+    matcher = loaded.matcher("aho-corasick")
+    assert isinstance(matcher.labels, memoryview)
+    assert matcher.tables().keys() == index.matcher().tables().keys()
+    encoded = [loaded.vocabulary.encode(example) for example in dataset]
+    assert matcher(encoded) == OverlapyNgramMatcher(index.ngrams())(encoded)
+
+    testset.add_example(["X"])
+    with pytest.raises(ValueError):
+        OverlapyIndex.load(tmp_path / "index", testsets=[testset, other])
+
+
+@pytest.mark.parametrize("engine", ["aho-corasick", "rolling-hash", "numpy"])
+def test_run_index(synthetic, tmp_path, engine):
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+    testset, dataset = synthetic
+    expected = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    OverlapyIndex.build([testset]).save(tmp_path / "index")
+    index = OverlapyIndex.load(tmp_path / "index")
+    matches = Overlapy(
+        testsets=[testset], dataset=dataset, n_workers=1, engine=engine, index=index
+    ).run()
+    assert matches == expected
+
+
+def test_ngram_index(examples1, ts1):
+    ts1.percentile = 60
+    assert ts1.ngram_index() == {
+        tuple("1234"): [(0, 0), (1, 0)],
+        tuple("2345"): [(0, 1)],
+    }
+    ts1.add_example("2345")
+    assert ts1.ngram_index()[tuple("2345")] == [(0, 1), (5, 0)]
+    ts1.examples[5] = "1234"
+    assert ts1.ngram_index()[tuple("2345")] == [(0, 1), (5, 0)]
+    ts1.reset()
+    assert ts1.ngram_index()[tuple("2345")] == [(0, 1)]
+    assert ts1.ngram_index()[tuple("1234")] == [(0, 0), (1, 0), (5, 0)]
+
+    ts1._ngram_index = None
+    list(ts1.ngrams())
+    assert ts1._ngram_index is None
+
+
+def test_get_matches(examples1, ts1):
+    from stringology.ac import AhoCorasick
+
+    def scan(matches):
+        ac = AhoCorasick(matches.keys())
+        return [
+            (i, ngram, position)
+            for i, example in enumerate(examples1)
+            for ngram, position in ac(example)
+        ]
+
+    ts1.percentile = 40
+    for matches in [
+        {"123": [0], "234": [1], "999": [2]},
+        {"234": [0], "12": [1], "2345": [0], "5": [0]},
+        {"1234": [0], "12345": [0], "2346": [1], "123456789": [2]},
+        {},
+    ]:
+        assert list(ts1.get_matches(matches)) == scan(matches)
+
+
+def test_report(synthetic, tmp_path):
+    testset, dataset = synthetic
+    matches = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    report = testset.report(matches)
+    assert list(report["ngrams"]) == [6, 4, 1, 4, 1]
+    assert list(report["matched"]) == [1, 1, 0, 1, 0]
+    assert list(report["overlap"]) == [1 / 6, 0.25, 0.0, 0.25, 0.0]
+    assert list(report["documents"]) == [2, 1, 0, 1, 0]
+    assert report["top_ngrams"][0] == [("A", "B", "A", "C")]
+    assert report["top_ngrams"][2] == []
+
+    testset.export_report(matches, tmp_path)
+    with open(tmp_path / "test.report.csv") as fr:
+        rows = list(csv.DictReader(fr))
+    assert [row["matched"] for row in rows] == ["1", "1", "0", "1", "0"]
+    assert json.loads(rows[1]["top_ngrams"]) == ["F J K H"]
+    with open(tmp_path / "test.dirty.jsonl") as fr:
+        assert [json.loads(line)["example"] for line in fr] == [0, 1, 3]
+    with open(tmp_path / "test.clean.jsonl") as fr:
+        assert [json.loads(line)["example"] for line in fr] == [2, 4]
+
+
+def test_report_str(ts1):
+    # The matches of str examples are keyed by str.
+    matches = Overlapy(testsets=[ts1], dataset=["51234", "999"], n_workers=1).run()
+    assert set(matches) == {"123", "234"}
+    report = ts1.report(matches)
+    assert list(report["matched"]) == [2, 2, 1, 0, 0]
+    assert list(report["documents"]) == [1, 1, 1, 0, 0]
+    assert report["top_ngrams"][2] == [tuple("123")]
+
+
+@pytest.mark.parametrize("results", ["occurrences", "documents", "counts"])
+def test_run_checkpoint(synthetic, tmp_path, results):
+    testset, dataset = synthetic
+    dataset = dataset * 3
+    expected = Overlapy(
+        testsets=[testset], dataset=dataset, n_workers=1, results=results
+    ).run()
+
+    def overlapy(chunk_size=4):
+        return Overlapy(
+            testsets=[testset],
+            dataset=dataset,
+            n_workers=1,
+            chunk_size=chunk_size,
+            results=results,
+            vocabulary=True,
+        )
+
+    assert overlapy().run(checkpoint_dir=tmp_path) == expected
+    # The manifest is a log: a header, then one line per finished work unit.
+    header, *shards = (tmp_path / "manifest.jsonl").read_text().splitlines()
+    assert json.loads(header)["settings"]["chunk_size"] == 4
+    shards = list(map(json.loads, shards))
+    assert sorted(shards)[0][:2] == [0, 4]
+    assert len(shards) == 4
+
+    # Resuming skips the finished work units: drop the last one to redo it,
+    # leaving the line recording it cut short, as after a crash.
+    (tmp_path / shards[-1][2]).unlink()
+    log = (tmp_path / "manifest.jsonl").read_text()
+    (tmp_path / "manifest.jsonl").write_text(log[: log.rindex("[")] + "[12, 1")
+    resumed = overlapy()
+    assert resumed.run(checkpoint_dir=tmp_path, merge=False) is None
+    (stats,) = resumed.worker_stats.values()
+    assert stats["tasks"] == 1
+    assert list(resumed.merge_checkpoint(tmp_path)) == sorted(expected.items())
+    assert resumed.run(checkpoint_dir=tmp_path) == expected
+
+    with pytest.raises(ValueError):
+        overlapy(chunk_size=3).run(checkpoint_dir=tmp_path)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_coordinator(synthetic, streaming):
+    testset, dataset = synthetic
+    overlapy = Overlapy(
+        testsets=[testset],
+        dataset=dataset,
+        n_workers=1,
+        streaming=streaming,
+        results="documents",
+    )
+    coordinator = OverlapyCoordinator(overlapy, chunk_size=2)
+    matches = coordinator.run(n_local_workers=2)
+    assert {ngram: list(idxs) for ngram, idxs in matches.items()} == {
+        ("A", "B", "A", "C"): [0, 3],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+    assert sum(stats["examples"] for stats in overlapy.worker_stats.values()) == 5
+
+
+def test_coordinator_worker_failure(synthetic):
+    testset, dataset = synthetic
+    overlapy = Overlapy(testsets=[testset], dataset=dataset, n_workers=1)
+    coordinator = OverlapyCoordinator(overlapy, chunk_size=2)
+
+    def workers():
+        # a worker that dies with its first work unit, then a healthy one
+        conn = Client(coordinator.address, authkey=coordinator.authkey)
+        conn.recv_bytes()
+        assert conn.recv()[0] == range(0, 2)
+        conn.close()
+        run_worker(coordinator.address, coordinator.authkey)
+
+    thread = threading.Thread(target=workers)
+    thread.start()
+    matches = coordinator.run()
+    thread.join()
+    assert coordinator.n_failures == 1
+    assert {ngram: sorted(idxs) for ngram, idxs in matches.items()} == {
+        ("A", "B", "A", "C"): [0, 3],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_corpus_summary(synthetic, tmp_path, streaming):
+    testset, dataset = synthetic
+    corpus = (example for example in dataset) if streaming else dataset
+    summary = OverlapyCorpusSummary.build(
+        corpus, tmp_path, sizes=[2, 4], n_workers=1, chunk_size=2
+    )
+    assert summary.shards == [[0, 2], [2, 4], [4, 5]]
+    assert summary.count([("A", "B", "A", "C"), ("L", "M"), ("M", "L")]) == [2, 1, 0]
+    with pytest.raises(ValueError):
+        summary.count([("A", "B", "A")])
+    matches = summary.query([testset])
+    assert matches == {
+        ("A", "B", "A", "C"): 2,
+        ("F", "J", "K", "H"): 1,
+        ("T", "Z", "V", "E"): 1,
+    }
+    assert [i for i, _, _ in testset.get_matches(matches)] == [0, 1, 3]
+    assert OverlapyCorpusSummary(tmp_path).query([testset]) == matches
+
+
+@pytest.mark.parametrize("shard_size", [1, 7, 1000])
+def test_suffix_array(synthetic, tmp_path, shard_size):
+    testset, dataset = synthetic
+    suffix_array = OverlapySuffixArray.build(
+        dataset + [[]], tmp_path, shard_size=shard_size, n_workers=1
+    )
+    text = [token for example in dataset + [[]] for token in example + [None]]
+    suffixes = [text[p:] for p in suffix_array.suffixes]
+    assert len(suffixes) == sum(map(len, dataset))
+    key = [[suffix_array.vocabulary.ids.get(token, 0) for token in s] for s in suffixes]
+    assert key == sorted(key)
+
+    assert suffix_array.count(["A", "B", "A", "C"]) == 2
+    assert suffix_array.locate(["A", "C"]) == [(0, 2), (1, 0), (3, 2)]
+    assert suffix_array.count(["E", "A"]) == 0
+    assert suffix_array.count(["X"]) == 0
+    assert suffix_array.longest_common_substring(["X", "C", "Ç", "T", "Z", "W"]) == (
+        4,
+        1,
+        (3, 3),
+    )
+    assert suffix_array.longest_common_substring(["X"]) == (0, None, None)
+    assert suffix_array.query([testset]) == {
+        ("A", "B", "A", "C"): 2,
+        ("F", "J", "K", "H"): 1,
+        ("T", "Z", "V", "E"): 1,
+    }
+    loaded = OverlapySuffixArray(tmp_path)
+    assert loaded.locate(["A", "B"]) == [(0, 0), (3, 0)]
+
+
+@pytest.mark.parametrize("block_size", [1, 4, 1 << 20])
+def test_merge_suffixes(tmp_path, block_size):
+    pytest.importorskip("numpy")
+    import overlapy
+
+    # long repeats, so that many suffixes share their first SUFFIX_KEY_DEPTH tokens
+    dataset = [list("abcab" * 8), list("abcab" * 7 + "x"), list("ab" * 20)]
+    suffix_array = OverlapySuffixArray.build(dataset, tmp_path, n_workers=1)
+    suffixes = list(suffix_array.suffixes)
+    shards = [memoryview(array("Q", suffixes[i::3])) for i in range(3)]
+    with open(tmp_path / "merged", "wb") as fw:
+        overlapy._merge_suffixes(suffix_array.text, shards, fw, block_size)
+    assert array("Q", (tmp_path / "merged").read_bytes()).tolist() == suffixes
+
+
+def whitespace_tokenizer(text):
+    return text.split()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_tokenized_corpus(synthetic, tmp_path, streaming):
+    import pickle
+
+    testset, dataset = synthetic
+    texts = [" ".join(example) for example in dataset]
+    corpus = OverlapyTokenizedCorpus.build(
+        (text for text in texts) if streaming else texts,
+        tmp_path,
+        whitespace_tokenizer,
+        n_workers=1,
+        chunk_size=2,
+    )
+    assert len(corpus) == len(dataset)
+    for i, example in enumerate(dataset):
+        assert corpus.vocabulary.decode(corpus[i]) == tuple(example)
+    with pytest.raises(IndexError):
+        corpus[len(dataset)]
+    assert list(pickle.loads(pickle.dumps(corpus))[3]) == list(corpus[3])
+
+    # Shards are mapped on demand, and only the most recently used stay open.
+    corpus = OverlapyTokenizedCorpus(tmp_path, max_open_shards=2)
+    assert not corpus.shards
+    assert [list(corpus[i]) for i in [0, 2, 4, 0]] == [
+        list(OverlapyTokenizedCorpus(tmp_path)[i]) for i in [0, 2, 4, 0]
+    ]
+    assert list(corpus.shards) == [2, 0]
+    assert pickle.loads(pickle.dumps(corpus)).max_open_shards == 2
+
+    expected = Overlapy(testsets=[testset], dataset=dataset, n_workers=1).run()
+    for engine in ["aho-corasick", "rolling-hash"]:
+        matches = Overlapy(
+            testsets=[testset],
+            dataset=OverlapyTokenizedCorpus(tmp_path),
+            n_workers=1,
+            engine=engine,
+        ).run()
+        assert matches == expected
+
+    suffix_array = OverlapySuffixArray.build(corpus, tmp_path / "sa", n_workers=1)
+    assert suffix_array.locate(["A", "B"]) == [(0, 0), (3, 0)]
+
+
+def test_tokenizer():
+    tokenize = OverlapyTokenizer()
+    assert tokenize("Hello, World!  It's 2021\te-mail_x") == [
+        "hello",
+        "world",
+        "it",
+        "s",
+        "2021",
+        "e",
+        "mail",
+        "x",
+    ]
+    assert tokenize("Çà va? Ça-va 42") == ["çà", "va", "ça", "va", "42"]
+    assert tokenize("") == []
+    text = "".join(map(chr, range(128))) * 2
+    assert tokenize(text) == OverlapyTokenizer.PATTERN.findall(text.lower())
+    assert tokenize.batch(["A b", "C"]) == [["a", "b"], ["c"]]
+    vocabulary = OverlapyVocabulary(["a", "b"])
+    assert list(tokenize.encode("B, z A", vocabulary)) == [2, 0, 1]
+
+
+def test_prefetch_reader(synthetic, tmp_path):
+    testset, dataset = synthetic
+    paths = []
+    for i, example in enumerate(dataset):
+        paths.append(tmp_path / f"{i}.txt")
+        paths[-1].write_text(" ".join(example))
+
+    def decode(data):
+        return data.decode().split()
+
+    reader = OverlapyPrefetchReader(paths, decode=decode, read_ahead=2)
+    assert list(reader) == dataset
+    matches = Overlapy(testsets=[testset], dataset=reader, n_workers=1).run()
+    assert dict(matches) == {
+        ("A", "B", "A", "C"): [0, 3],
+        ("F", "J", "K", "H"): [1],
+        ("T", "Z", "V", "E"): [3],
+    }
+
+    ranges = [(paths[0], 2, 3), (paths[1], 0, 1)]
+    assert list(OverlapyPrefetchReader(ranges)) == ["B A", "A"]
+
+    started = []
+
+    async def read(path):
+        started.append(path)
+        await asyncio.sleep(0.01)
+        return path.read_bytes()
+
+    reader = OverlapyPrefetchReader(paths, decode=decode, read=read, read_ahead=2)
+    documents = iter(reader)
+    assert next(documents) == dataset[0]
+    time.sleep(0.1)
+    # backpressure: no more than read_ahead documents are read ahead
+    assert len(started) <= 3
+    assert list(documents) == dataset[1:]
+
+
+def test_shard_reader(synthetic, tmp_path):
+    testset, dataset = synthetic
+    texts = [" ".join(example) for example in dataset]
+    with gzip.open(tmp_path / "0.jsonl.gz", "wt") as fw:
+        for text in texts[:3]:
+            fw.write(json.dumps({"id": 1, "text": text}) + "\n")
+    (tmp_path / "1.txt").write_text("\n".join(texts[3:]) + "\n")
+    (tmp_path / "2.jsonl").write_text("")
+    paths = [tmp_path / "0.jsonl.gz", tmp_path / "1.txt", tmp_path / "2.jsonl"]
+
+    reader = OverlapyShardReader(paths, n_workers=2)
+    assert list(reader.items()) == [
+        ((0, 0), texts[0]),
+        ((0, 1), texts[1]),
+        ((0, 2), texts[2]),
+        ((1, 0), texts[3]),
+        ((1, 1), texts[4]),
+    ]
+    assert [reader.locate(offset) for offset in (0, 2, 3, 4)] == [
+        (0, 0),
+        (0, 2),
+        (1, 0),
+        (1, 1),
+    ]
+    reader = OverlapyShardReader(paths, tokenizer=str.split, n_workers=1)
+    matches = Overlapy(testsets=[testset], dataset=reader, n_workers=1).run()
+    assert {reader.locate(idxs[-1]) for idxs in matches.values()} == {(1, 0), (0, 1)}
+    reader = OverlapyShardReader(paths[:1], field=lambda record: record["id"])
+    assert list(reader) == [1, 1, 1]
+
+
+def test_minhash(synthetic):
+    pytest.importorskip("numpy")
+    from overlapy import OverlapyMinHash
+
+    testset, dataset = synthetic
+    testset.examples.append("K E K W Y Z X S T".split())
+    dataset = dataset + ["K E K W Y Z X S T".split(), "K E K W Y Z X S U".split()]
+    minhash = OverlapyMinHash([testset], bands=32, rows=2)
+    pairs = minhash.run(dataset, n_workers=1)
+    assert (5, "test", 5, 1.0) in pairs
+    near = [pair for pair in pairs if pair[0] == 6]
+    assert [(i, name, j) for i, name, j, _ in near] == [(6, "test", 5)]
+    assert 0.5 < near[0][3] < 1.0
+    assert minhash.run(iter(dataset), threshold=1.0, n_workers=1, chunk_size=2) == [
+        pair for pair in pairs if pair[3] == 1.0
+    ]
+
+
+def test_main(synthetic, tmp_path, capsys):
+    testset, dataset = synthetic
+    for shard, examples in enumerate([dataset[:3], dataset[3:]]):
+        with gzip.open(tmp_path / f"corpus-{shard}.jsonl.gz", "wt") as fw:
+            for example in examples:
+                fw.write(json.dumps({"text": " ".join(example)}) + "\n")
+    (tmp_path / "testset.txt").write_text(
+        "\n".join(" ".join(example) for example in testset.examples) + "\n"
+    )
+    config = {
+        "testsets": [
+            {"name": "test", "paths": [str(tmp_path / "testset.txt")], "min_n": 1}
+        ],
+        "corpus": [str(tmp_path / "corpus-*.jsonl.gz")],
+        "tokenizer": "whitespace",
+        "n_workers": 1,
+        "output": str(tmp_path / "output"),
+    }
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    main([str(tmp_path / "config.json")])
+    assert "reusing" not in capsys.readouterr().err
+
+    (results,) = (tmp_path / "output").glob("results-*")
+    with open(results / "matches.jsonl") as fr:
+        matches = [json.loads(line) for line in fr]
+    shard = str(tmp_path / "corpus-{}.jsonl.gz").format
+    assert matches == [
+        {"ngram": ["A", "B", "A", "C"], "documents": [[shard(0), 0], [shard(1), 0]]},
+        {"ngram": ["F", "J", "K", "H"], "documents": [[shard(0), 1]]},
+        {"ngram": ["T", "Z", "V", "E"], "documents": [[shard(1), 0]]},
+    ]
+    with open(results / "contaminated.json") as fr:
+        assert [match["example"] for match in json.load(fr)["test"]] == [0, 1, 3]
+
+    main([str(tmp_path / "config.json")])
+    assert capsys.readouterr().err.count("reusing") == 4